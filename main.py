@@ -11,11 +11,40 @@ def parse_args():
     parser.add_argument("--task", type=str, default="rag", choices=["en", "zh", "rag"])
     parser.add_argument("--output_dir", type=str, default="./results_zh")
     parser.add_argument("--chunk_length", type=int, default=8000)
+    parser.add_argument("--chunk_mode", type=str, default="token", choices=["token", "boundary"])
     parser.add_argument("--input_length", type=int, default=8000)
-    parser.add_argument("--api_url", type=str, default=str(os.getenv("OPENAI_BASE_URL")))
+    parser.add_argument("--api_url", type=str, nargs="+", default=[str(os.getenv("OPENAI_BASE_URL"))])
     parser.add_argument("--api_key", type=str, default=str(os.getenv("OPENAI_API_KEY")))
     parser.add_argument("--model", type=str, default="gpt-4o-mini-2024-07-18")
     parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--max_inflight", type=int, default=64)
+    parser.add_argument("--chunk_concurrency", type=int, default=0)
+    parser.add_argument("--adaptive_concurrency", action="store_true")
+    parser.add_argument("--min_inflight", type=int, default=1)
+    parser.add_argument("--request_timeout", type=float, default=120.0)
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument("--retry_budget", type=float, default=0.2)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--hedge_percentile", type=float, default=0, help="Hedge map calls slower than this latency percentile, 0 to disable")
+    parser.add_argument("--hedge_max_rate", type=float, default=0.05)
+    parser.add_argument("--tokenize_workers", type=int, default=0, help="Processes chunking examples ahead of the worker threads")
+    parser.add_argument("--token_cache_dir", type=str, default=None, help="Directory of cached context encodings")
+    parser.add_argument("--price_table", type=str, default=None, help="JSON file of model prices in USD per million tokens")
+    parser.add_argument("--prompt_layout", type=str, default="default", choices=["default", "prefix"])
+    parser.add_argument("--map_output", type=str, default="text", choices=["text", "json", "json_object", "json_schema"])
+    parser.add_argument("--rpm", type=int, default=0)
+    parser.add_argument("--cache_path", type=str, default=None)
+    parser.add_argument("--cache_size_mb", type=int, default=1024)
+    parser.add_argument("--cache_read_only", action="store_true")
+    parser.add_argument("--tpm", type=int, default=0)
+    parser.add_argument("--map_max_tokens", type=int, default=2048)
+    parser.add_argument("--score_max_tokens", type=int, default=16)
+    parser.add_argument("--score_batch_tokens", type=int, default=0, help="Score extracted information in calls of up to this many tokens, 0 for one call per chunk")
+    parser.add_argument("--reduce_max_tokens", type=int, default=256)
+    parser.add_argument("--postprocess_max_tokens", type=int, default=64)
+    parser.add_argument("--no_stop_sequences", action="store_true")
+    parser.add_argument("--execution", type=str, default="online", choices=["online", "batch"])
+    parser.add_argument("--batch_poll_interval", type=float, default=30.0)
     parser.add_argument("--data_path", type=str, default=None)
     return parser.parse_args()
 
@@ -29,8 +58,34 @@ def main():
     input_length = args.input_length
     data_path = args.data_path
     
+    # Initialize tokenizer
+    tokenizer = tiktoken.encoding_for_model("gpt-4o")
+    
     # Initialize OpenAI client and set global variables
-    utils.initialize_client(args.api_url, args.api_key, args.model)
+    utils.initialize_client(
+        args.api_url,
+        args.api_key,
+        args.model,
+        max_inflight=args.max_inflight,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        tokenizer=tokenizer,
+        adaptive_concurrency=args.adaptive_concurrency,
+        min_inflight=args.min_inflight,
+        timeout=args.request_timeout,
+        max_retries=args.max_retries,
+        retry_budget=args.retry_budget,
+        stream=args.stream,
+        hedge_percentile=args.hedge_percentile or None,
+        hedge_max_rate=args.hedge_max_rate,
+    )
+    for stage in ["map", "score", "reduce", "postprocess"]:
+        stop = None if args.no_stop_sequences else utils.get_generation_limits()[stage]["stop"]
+        utils.set_generation_limits(stage, max_tokens=getattr(args, f"{stage}_max_tokens"), stop=stop)
+    if args.token_cache_dir:
+        utils.initialize_token_cache(args.token_cache_dir)
+    if args.cache_path:
+        utils.initialize_cache(args.cache_path, max_size_mb=args.cache_size_mb, read_only=args.cache_read_only)
     
     # Check if the model is an open source model (like Llama)
     is_open_source_model = "llama" in args.model.lower()
@@ -55,9 +110,6 @@ def main():
     print(f"Loading data from {data_path}")
     examples = list(utils.iter_jsonl(data_path))
     
-    # Initialize tokenizer
-    tokenizer = tiktoken.encoding_for_model("gpt-4o")
-    
     # Process examples with pipeline
     final_preds, run_time_info = pipeline.run_pipeline(
         examples,
@@ -66,7 +118,16 @@ def main():
         chunk_length,
         input_length,
         output_dir,
-        max_workers=args.num_workers
+        max_workers=args.num_workers,
+        chunk_concurrency=args.chunk_concurrency,
+        execution=args.execution,
+        batch_poll_interval=args.batch_poll_interval,
+        prompt_layout=args.prompt_layout,
+        price_table=args.price_table,
+        tokenize_workers=args.tokenize_workers,
+        chunk_mode=args.chunk_mode,
+        score_batch_tokens=args.score_batch_tokens,
+        map_output=args.map_output,
     )
 
 
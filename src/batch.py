@@ -0,0 +1,152 @@
+import asyncio
+import json
+from pathlib import Path
+
+from . import llm
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# Batch API limits per batch, the size limit applies to the input file
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_FILE_BYTES = 200 * 1000 * 1000
+
+
+def _batch_line(custom_id, body):
+    line = {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+    return json.dumps(line, ensure_ascii=False) + "\n"
+
+
+def write_batch_file(requests, path):
+    """
+    Write requests to a JSONL file in OpenAI Batch API format
+
+    Args:
+        requests: Dict mapping custom_id to a chat completion request body
+        path: Output file path
+    """
+    with open(path, "w", encoding="utf8") as fout:
+        for custom_id, body in requests.items():
+            fout.write(_batch_line(custom_id, body))
+
+
+def split_requests(requests, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_FILE_BYTES):
+    """
+    Split requests into consecutive parts that each fit in one batch
+
+    Args:
+        requests: Dict mapping custom_id to a chat completion request body
+        max_requests: Maximum number of requests per part
+        max_bytes: Maximum size of the input file of a part in bytes
+
+    Returns:
+        List of dicts mapping custom_id to request body, in the order of requests
+    """
+    parts = []
+    part, size = {}, 0
+    for custom_id, body in requests.items():
+        line_size = len(_batch_line(custom_id, body).encode("utf8"))
+        if part and (len(part) >= max_requests or size + line_size > max_bytes):
+            parts.append(part)
+            part, size = {}, 0
+        part[custom_id] = body
+        size += line_size
+    if part:
+        parts.append(part)
+    return parts
+
+
+def parse_batch_output(text, usage=None):
+    """
+    Parse a Batch API output file
+
+    Args:
+        text: Content of the output file
+        usage: Optional dict, filled with the token usage of each successful request by custom_id
+
+    Returns:
+        Dict mapping custom_id to response content, failed requests are left out
+    """
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            continue
+        choices = response.get("body", {}).get("choices") or []
+        content = choices[0].get("message", {}).get("content") if choices else None
+        if content:
+            results[record["custom_id"]] = content
+            if usage is not None:
+                usage[record["custom_id"]] = response["body"].get("usage")
+    return results
+
+
+async def _submit_and_wait(path, poll_interval):
+    client = llm.client
+    with open(path, "rb") as fin:
+        batch_file = await client.files.create(file=(Path(path).name, fin.read()), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    print(f"Submitted batch {batch.id} from {path}")
+
+    while batch.status not in FINAL_STATUSES:
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        progress = f"{counts.completed}/{counts.total} done, {counts.failed} failed" if counts else ""
+        print(f"Batch {batch.id}: {batch.status} {progress}")
+
+    if not batch.output_file_id:
+        print(f"Batch {batch.id} ended as {batch.status} without output")
+        return ""
+    output = await client.files.content(batch.output_file_id)
+    return output.text
+
+
+def run_batch(
+    requests, path, poll_interval=30.0, usage=None, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_FILE_BYTES
+):
+    """
+    Execute requests through the Batch API and wait for the results
+
+    Requests beyond the per-batch limits are split into several batches,
+    submitted at once and polled concurrently.
+
+    Args:
+        requests: Dict mapping custom_id to a chat completion request body
+        path: Where to write the batch input file, the output is saved next to it; with
+            several batches, the files are numbered (batch_map_1.jsonl, ...)
+        poll_interval: Seconds between status checks
+        usage: Optional dict, filled with the token usage of each successful request by custom_id
+        max_requests: Maximum number of requests per batch
+        max_bytes: Maximum size of the input file of a batch in bytes
+
+    Returns:
+        Dict mapping custom_id to response content, failed requests are left out
+    """
+    if not requests:
+        return {}
+    path = Path(path)
+    parts = split_requests(requests, max_requests=max_requests, max_bytes=max_bytes)
+    if len(parts) == 1:
+        paths = [path]
+    else:
+        paths = [path.with_name(f"{path.stem}_{n}{path.suffix}") for n in range(1, len(parts) + 1)]
+        print(f"Splitting {len(requests)} requests into {len(parts)} batches")
+    for part, part_path in zip(parts, paths):
+        write_batch_file(part, part_path)
+
+    async def submit_all():
+        return await asyncio.gather(*(_submit_and_wait(part_path, poll_interval) for part_path in paths))
+
+    results = {}
+    for part_path, text in zip(paths, llm.run(submit_all())):
+        part_path.with_name(part_path.stem + "_output.jsonl").write_text(text, encoding="utf8")
+        results.update(parse_batch_output(text, usage))
+    print(f"Batch returned {len(results)}/{len(requests)} responses")
+    return results
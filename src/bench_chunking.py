@@ -0,0 +1,172 @@
+"""
+Benchmark of the chunking path
+
+Chunks the contexts of a dataset from a pool of worker threads, as the
+pipeline does, and reports the time, peak RSS and chunks of each token
+representation and chunk mode. Every configuration runs in a fresh
+process, so peak RSS values are comparable:
+
+    python -m src.bench_chunking --data_path ./data/rag_1000k.jsonl --workers 8 32
+    python -m src.bench_chunking --data_path ./data/rag_1000k.jsonl --workers 1 --chunk_modes token boundary --manner front
+
+Representations:
+    list: tokenizer.encode() of the whole context as a list of ints, list
+        truncation and a decode() per chunk (the original path)
+    array: create_chunks, encoding only the kept parts of the context into
+        uint32 arrays that are truncated and chunked as views
+    cache: create_chunks with contexts taken from --token_cache_dir
+
+Besides the number of chunks, the number of cuts inside a unit is reported:
+chunk ends (other than the last of a context) not at a blank line, where
+documents and paragraphs are separated, and not at any unit boundary
+(blank line, line break or sentence end), see utils.UNIT_BOUNDARIES.
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import utils
+from .token_cache import TokenCache
+
+REPRESENTATIONS = ("list", "array", "cache")
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB, or the peak where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as fin:
+            pages = int(fin.read().split()[1])
+        return pages * resource.getpagesize() / 1024 ** 2
+    except OSError:
+        return peak_rss_mb()
+
+
+def unit_cuts(chunks):
+    """Number of chunk ends inside a document or paragraph, and inside a line or sentence"""
+    inside_document = inside_sentence = 0
+    for chunk in chunks[:-1]:
+        tail = chunk[-16:].encode("utf8")
+        ends = [any(match.end() == len(tail) for match in pattern.finditer(tail)) for pattern in utils.UNIT_BOUNDARIES]
+        inside_document += not ends[0]
+        inside_sentence += not any(ends)
+    return inside_document, inside_sentence
+
+
+def chunk_as_list(tokenizer, context, chunk_length, input_length, manner="middle"):
+    tokens = utils.truncate_input(tokenizer.encode(context), input_length, manner=manner)
+    return [tokenizer.decode(chunk) for chunk in utils.chunk_input(tokens, chunk_length)]
+
+
+def run_one(args):
+    """Chunk every context with one representation, chunk mode and worker count, print the result as JSON"""
+    import tiktoken
+
+    tokenizer = tiktoken.encoding_for_model(args.model)
+    contexts = [example[args.field] for example in utils.iter_jsonl(args.data_path, cnt=args.limit)]
+    token_cache = TokenCache(args.token_cache_dir, read_only=True) if args.representation == "cache" else None
+    # Warm up the tokenizer (and byte length table) outside the measurement
+    utils.create_chunks(tokenizer, contexts[0][:10000], args.chunk_length, args.input_length)
+    baseline = current_rss_mb()
+
+    def chunk(context):
+        start = time.perf_counter()
+        if args.representation == "list":
+            chunks = chunk_as_list(tokenizer, context, args.chunk_length, args.input_length, manner=args.manner)
+        else:
+            chunks = utils.create_chunks(
+                tokenizer, context, args.chunk_length, args.input_length, manner=args.manner,
+                token_cache=token_cache, chunk_mode=args.chunk_modes[0],
+            )
+        return len(chunks), unit_cuts(chunks), time.perf_counter() - start
+
+    start = time.perf_counter()
+    num_chunks = inside_document = inside_sentence = 0
+    chunking_seconds = 0.0
+    with ThreadPoolExecutor(max_workers=args.workers[0]) as executor:
+        for count, cuts, elapsed in executor.map(chunk, contexts):
+            num_chunks += count
+            inside_document += cuts[0]
+            inside_sentence += cuts[1]
+            chunking_seconds += elapsed
+    seconds = time.perf_counter() - start
+    result = {
+        "representation": args.representation,
+        "chunk_mode": args.chunk_modes[0],
+        "workers": args.workers[0],
+        "examples": len(contexts),
+        "chunks": num_chunks,
+        "cuts_inside_document": inside_document,
+        "cuts_inside_sentence": inside_sentence,
+        "seconds": seconds,
+        "chunking_seconds": chunking_seconds,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if token_cache is not None:
+        result["token_cache"] = token_cache.stats()
+    print(json.dumps(result))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, default="./data/rag_1000k.jsonl")
+    parser.add_argument("--field", type=str, default="context", help="Field of each example holding the text")
+    parser.add_argument("--limit", type=int, default=32, help="Number of examples to chunk")
+    parser.add_argument("--model", type=str, default="gpt-4o", help="Model whose tiktoken encoding is used")
+    parser.add_argument("--chunk_length", type=int, default=8000)
+    parser.add_argument("--input_length", type=int, default=128000)
+    parser.add_argument("--manner", type=str, default="middle", choices=["middle", "front"], help="Truncation, the pipeline uses front for rag")
+    parser.add_argument("--workers", type=int, nargs="+", default=[8, 32], help="Worker thread counts to compare")
+    parser.add_argument("--representations", type=str, nargs="+", default=["list", "array"], choices=REPRESENTATIONS)
+    parser.add_argument("--chunk_modes", type=str, nargs="+", default=["token"], choices=utils.CHUNK_MODES)
+    parser.add_argument("--token_cache_dir", type=str, default="./token_cache", help="Token cache for the cache representation")
+    parser.add_argument("--representation", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.representation:
+        run_one(args)
+        return
+
+    results = []
+    for workers in args.workers:
+        for representation in args.representations:
+            for chunk_mode in args.chunk_modes:
+                if representation == "list" and chunk_mode != "token":
+                    # The original path only cuts every chunk_length tokens
+                    continue
+                command = [sys.executable, "-m", "src.bench_chunking", "--representation", representation]
+                for name in (
+                    "data_path", "field", "limit", "model", "chunk_length", "input_length", "manner", "token_cache_dir"
+                ):
+                    command += [f"--{name}", str(getattr(args, name))]
+                command += ["--workers", str(workers), "--chunk_modes", chunk_mode]
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                results.append(result)
+                print(
+                    f"{representation:>6} {chunk_mode:>8} x{workers:<3} {result['seconds']:7.2f}s "
+                    f"({result['chunking_seconds']:.2f}s chunking)  "
+                    f"peak RSS {result['peak_rss_mb']:8.1f} MB  "
+                    f"(+{result['peak_rss_mb'] - result['baseline_rss_mb']:.1f} MB over loaded data)  "
+                    f"{result['chunks']} chunks, {result['cuts_inside_document']} cut inside a document/paragraph, "
+                    f"{result['cuts_inside_sentence']} inside a sentence"
+                )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+def make_key(model, messages, temperature, **params):
+    """
+    Content address of a chat request
+
+    Args:
+        model: Model name
+        messages: Chat messages
+        temperature: Sampling temperature
+        params: Any other sampling parameters sent with the request
+
+    Returns:
+        Hex SHA-256 digest identifying the request
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "params": {k: v for k, v in params.items() if v is not None},
+    }
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of LLM responses keyed by make_key
+
+    The cache holds at most `max_size_mb` of response text and evicts the
+    least recently used entries beyond that. In read-only mode it serves hits
+    but never writes, so benchmark runs see exactly the stored responses.
+    Access times of hits are written in batches of `touch_batch` (or every
+    `touch_interval` seconds) rather than with a commit per hit.
+    """
+
+    touch_batch = 256
+    touch_interval = 5.0
+
+    def __init__(self, path, max_size_mb=1024, read_only=False):
+        self.path = Path(path)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._touch_flushed = time.monotonic()
+
+        if read_only:
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._conn.commit()
+        self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """Return the cached response for key, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._touched[key] = time.time()
+                if len(self._touched) >= self.touch_batch or time.monotonic() - self._touch_flushed > self.touch_interval:
+                    self._flush_touched()
+                    self._conn.commit()
+            return row[0]
+
+    def _flush_touched(self):
+        """Write the pending access times of hits, the caller holds the lock and commits"""
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in self._touched.items()],
+            )
+            self._touched.clear()
+        self._touch_flushed = time.monotonic()
+
+    def put(self, key, value):
+        """Store a response, evicting least recently used entries over the size bound"""
+        if self.read_only:
+            return
+        size = len(value.encode("utf8"))
+        with self._lock:
+            # Eviction must see the latest access times
+            self._flush_touched()
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self.size += size - (old[0] if old else 0)
+            while self.size > self.max_size:
+                rows = self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+                ).fetchall()
+                if not rows:
+                    break
+                for old_key, old_size in rows:
+                    if self.size <= self.max_size:
+                        break
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    self.size -= old_size
+                    self.evictions += 1
+            self._conn.commit()
+
+    def stats(self):
+        """Hit/miss counters and current size, writes the pending access times"""
+        if not self.read_only:
+            with self._lock:
+                self._flush_touched()
+                self._conn.commit()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size_bytes": self.size,
+        }
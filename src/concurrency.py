@@ -0,0 +1,109 @@
+import time
+import openai
+
+
+def is_overload_error(exc):
+    """Whether an exception signals that the backend is overloaded (429, 5xx or timeout)"""
+    if isinstance(exc, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+class AIMDController:
+    """
+    Additive-increase / multiplicative-decrease control of the in-flight limit
+
+    The limit grows by `increase` after every window of `limit` healthy
+    completions while the limit is actually binding, and is multiplied by
+    `decrease` on 429/5xx/timeouts or when a call takes more than
+    `latency_factor` times the usual latency of its stage. Only one cut is
+    made per congestion event: failures of requests started before the last
+    cut are ignored. Slow calls still move the latency baseline, at the
+    slower rate `spike_alpha`, so a lasting rise in latency (longer prompts,
+    a slower but healthy backend) becomes the new baseline instead of
+    pinning the limit at `min_limit`. Must only be used from the client
+    event loop.
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        min_limit=1,
+        max_limit=64,
+        increase=1.0,
+        decrease=0.5,
+        latency_factor=3.0,
+        ewma_alpha=0.1,
+        spike_alpha=0.02,
+        warmup=5,
+    ):
+        self.scheduler = scheduler
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.ewma_alpha = ewma_alpha
+        self.spike_alpha = spike_alpha
+        self.warmup = warmup
+        self.limit = float(max(min_limit, max_limit // 4))
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._latency = {}
+        self._samples = {}
+        self.scheduler.set_limit(int(self.limit))
+        print(f"[concurrency] initial in-flight limit {int(self.limit)} (min {min_limit}, max {max_limit})")
+
+    def on_success(self, stage, started, latency):
+        """
+        Record a successful call
+
+        Args:
+            stage: Pipeline stage of the call
+            started: time.monotonic() when the call was sent
+            latency: Duration of the call in seconds
+        """
+        samples = self._samples.get(stage, 0)
+        baseline = self._latency.get(stage, latency)
+        if samples >= self.warmup and latency > self.latency_factor * baseline:
+            self._latency[stage] = (1 - self.spike_alpha) * baseline + self.spike_alpha * latency
+            self._cut(started, f"{stage} latency {latency:.1f}s > {self.latency_factor:g}x {baseline:.1f}s")
+            return
+
+        self._samples[stage] = samples + 1
+        self._latency[stage] = (1 - self.ewma_alpha) * baseline + self.ewma_alpha * latency
+
+        # Only probe for more capacity when the limit is what holds requests back
+        if self.scheduler.in_flight + self.scheduler.waiting() + 1 < int(self.limit):
+            return
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._successes = 0
+            self._set(self.limit + self.increase, "healthy")
+
+    def on_error(self, started, exc):
+        """
+        Record a failed call
+
+        Args:
+            started: time.monotonic() when the call was sent
+            exc: The exception raised by the call
+        """
+        if is_overload_error(exc):
+            self._cut(started, type(exc).__name__)
+
+    def _cut(self, started, reason):
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self._successes = 0
+        self._set(self.limit * self.decrease, reason)
+
+    def _set(self, limit, reason):
+        old = int(self.limit)
+        self.limit = min(float(self.max_limit), max(float(self.min_limit), limit))
+        if int(self.limit) != old:
+            print(f"[concurrency] in-flight limit {old} -> {int(self.limit)} ({reason})")
+            self.scheduler.set_limit(int(self.limit))
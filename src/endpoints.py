@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import openai
+
+
+def is_endpoint_failure(exc):
+    """Whether an error suggests the endpoint itself is unhealthy (connection, timeout or 5xx)"""
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code >= 500
+    return False
+
+
+class Endpoint:
+    """One OpenAI-compatible replica and its routing state"""
+
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.requests = 0
+
+
+class EndpointPool:
+    """
+    Route requests over several replicas
+
+    Requests without an affinity key go to the healthy endpoint with the
+    fewest outstanding requests. Requests with an affinity key, e.g.
+    (example id, chunk id), are placed by rendezvous hashing so that a chunk
+    resent in later iterations reaches the replica that already holds its
+    prefix KV cache. An endpoint only takes affine requests while it is below
+    `load_factor` times the mean load (plus one), otherwise the next replica
+    in the key's hash order is used. Endpoints are ejected after
+    `eject_after` consecutive failures and re-probed every `probe_interval`
+    seconds until they answer again. Must only be used from the client event loop.
+    """
+
+    def __init__(self, endpoints, eject_after=3, probe_interval=10.0, load_factor=1.25):
+        self.endpoints = endpoints
+        self.eject_after = eject_after
+        self.probe_interval = probe_interval
+        self.load_factor = load_factor
+
+    def _available(self):
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        # With every replica ejected, keep trying all of them rather than failing outright
+        return healthy or self.endpoints
+
+    def pick(self, affinity=None):
+        """
+        Choose the endpoint for a request
+
+        Args:
+            affinity: Optional hashable key, equal keys prefer the same endpoint
+
+        Returns:
+            The selected Endpoint
+        """
+        available = self._available()
+        if affinity is None or len(available) == 1:
+            return min(available, key=lambda endpoint: endpoint.outstanding)
+
+        mean_load = sum(endpoint.outstanding for endpoint in available) / len(available)
+        bound = self.load_factor * mean_load + 1
+        ranked = sorted(available, key=lambda endpoint: _rendezvous_score(affinity, endpoint.url), reverse=True)
+        for endpoint in ranked:
+            if endpoint.outstanding < bound:
+                return endpoint
+        return ranked[0]
+
+    def on_success(self, endpoint):
+        endpoint.failures = 0
+
+    def on_error(self, endpoint, exc):
+        if not is_endpoint_failure(exc):
+            return
+        endpoint.failures += 1
+        if endpoint.healthy and endpoint.failures >= self.eject_after:
+            endpoint.healthy = False
+            print(f"[endpoints] ejected {endpoint.url} after {endpoint.failures} consecutive failures: {exc}")
+
+    async def probe_forever(self):
+        """Periodically re-check ejected endpoints and restore the ones that answer"""
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    continue
+                try:
+                    await endpoint.client.models.list(timeout=self.probe_interval)
+                except Exception:
+                    continue
+                endpoint.healthy = True
+                endpoint.failures = 0
+                print(f"[endpoints] restored {endpoint.url}")
+
+    def stats(self):
+        """Per-endpoint request counts and health"""
+        return {
+            endpoint.url: {"requests": endpoint.requests, "healthy": endpoint.healthy}
+            for endpoint in self.endpoints
+        }
+
+
+def _rendezvous_score(key, url):
+    digest = hashlib.blake2b(f"{key}|{url}".encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
@@ -9,6 +9,7 @@ from pathlib import Path
 from typing import Optional
 
 # import jieba
+import numpy as np
 from rouge import Rouge
 
 from prompt import (
@@ -376,12 +377,15 @@ def create_prompt(eg: dict, data_name: str, model_name: Optional[str], data_dir)
     return prompt
 
 
-def create_prompts(tokenizer, eg: dict, data_name: str, model_name: Optional[str], data_dir, chunk_size) -> list[str]:
+def create_prompts(
+    tokenizer, eg: dict, data_name: str, model_name: Optional[str], data_dir, chunk_size, token_cache=None
+) -> list[str]:
     prompts = []
     context = eg["context"]
 
     if tokenizer:
-        tokens = tokenizer.encode(context)
+        # token_cache: optional src.token_cache.TokenCache holding pre-encoded contexts
+        tokens = token_cache.encode(tokenizer, context) if token_cache is not None else tokenizer.encode(context)
         print(f"Total tokens: {len(tokens)}")
         chunked_tokens = chunk_input(tokens, chunk_size)
         chunks = [tokenizer.decode(chunked_token) for chunked_token in chunked_tokens]
@@ -396,12 +400,14 @@ def create_prompts(tokenizer, eg: dict, data_name: str, model_name: Optional[str
     return prompts
 
 
-def create_prompts_new(tokenizer, eg: dict, data_name: str, model_name: Optional[str], data_dir, chunk_size, input_length) -> list[str]:
+def create_prompts_new(
+    tokenizer, eg: dict, data_name: str, model_name: Optional[str], data_dir, chunk_size, input_length, token_cache=None
+) -> list[str]:
     prompts = []
     context = eg["context"]
 
     if tokenizer:
-        tokens = tokenizer.encode(context)
+        tokens = token_cache.encode(tokenizer, context) if token_cache is not None else tokenizer.encode(context)
         print(f"Before truncation: {len(tokens)}")
         tokens = truncate_input(tokens, input_length, manner="middle")
         print(f"After truncation: {len(tokens)}")  # type: ignore
@@ -500,12 +506,12 @@ def create_msgs(
 
 
 def create_chunked_msgs(
-    tokenizer, eg: dict, data_name: str, data_dir, chunk_size, model_name: Optional[str] = None
+    tokenizer, eg: dict, data_name: str, data_dir, chunk_size, model_name: Optional[str] = None, token_cache=None
 ) -> list[tuple[list[dict], str]]:
     """
     Create chunked messages for a given example.
     """
-    chunked_prompts = create_prompts(tokenizer, eg, data_name, model_name, data_dir, chunk_size)
+    chunked_prompts = create_prompts(tokenizer, eg, data_name, model_name, data_dir, chunk_size, token_cache=token_cache)
 
     # Check if tokenizer is provided and initialized
     # if tokenizer:
@@ -539,12 +545,14 @@ def create_chunked_msgs(
 
 
 def create_chunked_msgs_new(
-    tokenizer, eg: dict, data_name: str, data_dir, chunk_size, input_length, model_name: Optional[str] = None
+    tokenizer, eg: dict, data_name: str, data_dir, chunk_size, input_length, model_name: Optional[str] = None, token_cache=None
 ) -> list[tuple[list[dict], str]]:
     """
     Create chunked messages for a given example.
     """
-    chunked_prompts = create_prompts_new(tokenizer, eg, data_name, model_name, data_dir, chunk_size, input_length)
+    chunked_prompts = create_prompts_new(
+        tokenizer, eg, data_name, model_name, data_dir, chunk_size, input_length, token_cache=token_cache
+    )
 
     chunked_msgs = []
     for chunked_prompt in chunked_prompts:
@@ -691,6 +699,9 @@ def truncate_input(input, max_length, manner="middle"):
     if len(input) <= max_length:
         return input
     if manner == "middle":
+        if isinstance(input, np.ndarray):
+            # Token arrays from a token cache add elementwise, join them instead
+            return np.concatenate([input[0 : max_length // 2], input[-max_length // 2 :]])
         return input[0 : max_length // 2] + input[-max_length // 2 :]
     else:
         return None
@@ -0,0 +1,107 @@
+import asyncio
+import bisect
+import collections
+import time
+
+
+class LatencyTracker:
+    """Sliding window of recent call latencies with percentile lookup"""
+
+    def __init__(self, window=512):
+        self._recent = collections.deque(maxlen=window)
+        self._sorted = []
+
+    def __len__(self):
+        return len(self._recent)
+
+    def add(self, latency):
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self._recent.append(latency)
+        bisect.insort(self._sorted, latency)
+
+    def percentile(self, p):
+        """Latency below which p percent of the window falls, None while empty"""
+        if not self._sorted:
+            return None
+        idx = min(len(self._sorted) - 1, int(len(self._sorted) * p / 100))
+        return self._sorted[idx]
+
+
+class Hedger:
+    """
+    Hedged requests against tail latency
+
+    When an upstream call has not answered after the `percentile` latency of
+    its stage, a duplicate is sent; the first successful response wins and
+    the other call is cancelled. The timer starts once the call has left the
+    scheduler and rate limiter, so queueing under load never triggers hedges.
+    At most `max_rate` hedges are sent per call, and no hedges are sent before
+    `warmup` latencies of the stage are known. Must only be used from the
+    client event loop.
+    """
+
+    def __init__(self, percentile=95.0, max_rate=0.05, stages=("map",), warmup=20, window=512):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.stages = stages
+        self.warmup = warmup
+        self.window = window
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0
+        self._latency = {}
+
+    def threshold(self, stage):
+        """Seconds after which a call of the stage is hedged, None when it is not"""
+        tracker = self._latency.get(stage)
+        if stage not in self.stages or tracker is None or len(tracker) < self.warmup:
+            return None
+        return tracker.percentile(self.percentile)
+
+    async def run(self, stage, attempt):
+        """
+        Run a call, hedging it if it is slow
+
+        Args:
+            stage: Pipeline stage of the call
+            attempt: Coroutine function attempt(sent, hedge) performing the call, it must
+                set the asyncio.Event `sent` once the request goes upstream
+
+        Returns:
+            Result of the first successful attempt
+        """
+        self.calls += 1
+        sent = asyncio.Event()
+        primary = asyncio.ensure_future(attempt(sent, False))
+        sent_wait = asyncio.ensure_future(sent.wait())
+        tasks = [primary, sent_wait]
+        try:
+            await asyncio.wait([primary, sent_wait], return_when=asyncio.FIRST_COMPLETED)
+            started = time.monotonic()
+            delay = self.threshold(stage)
+            if delay is not None and not primary.done():
+                await asyncio.wait([primary], timeout=delay)
+                if not primary.done() and self.hedges < self.max_rate * self.calls:
+                    self.hedges += 1
+                    tasks.append(asyncio.ensure_future(attempt(asyncio.Event(), True)))
+
+            pending = set(tasks) - {sent_wait}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.wins += 1
+                        self._latency.setdefault(stage, LatencyTracker(self.window)).add(time.monotonic() - started)
+                        return task.result()
+            # Every attempt failed, report the original call's error
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {"hedges": self.hedges, "hedge_wins": self.wins}
@@ -0,0 +1,503 @@
+import asyncio
+import threading
+import time
+import httpx
+from openai import AsyncOpenAI
+
+from .cache import ResponseCache, make_key
+from .concurrency import AIMDController
+from .endpoints import Endpoint, EndpointPool
+from .hedge import Hedger
+from .rate_limit import RateLimiter
+from .retry import IncompleteResponseError, RetryPolicy
+from .scheduler import PriorityScheduler
+from .singleflight import SingleFlight
+from .usage import UsageTracker
+
+# Global async client state. All requests run on a single background event
+# loop, so worker threads share one connection pool and one in-flight limit.
+client = None
+endpoint_pool = None
+_probe_future = None
+model = None
+loop = None
+scheduler = None
+rate_limiter = None
+controller = None
+retry_policy = None
+hedger = None
+request_timeout = None
+cache = None
+singleflight = SingleFlight()
+prefilled = {}
+stream = False
+stream_stats = {"early_stopped": 0, "ttft_total": {}, "ttft_count": {}}
+# Token usage reported by the API for every call, tagged by stage, iteration and example
+usage = UsageTracker()
+
+# Map outputs starting with this marker carry nothing else of use
+NO_INFORMATION = "NO INFORMATION"
+
+# Generation limits per stage. Scores are a single "Score: N" line, reduce
+# answers are a word or phrase, and postprocessing only outputs the answer.
+generation_limits = {
+    "map": {"max_tokens": 2048, "stop": None},
+    "score": {"max_tokens": 16, "stop": ["\n"]},
+    "reduce": {"max_tokens": 256, "stop": ["\n\n"]},
+    "postprocess": {"max_tokens": 64, "stop": ["\n"]},
+}
+max_inflight = None
+
+# Example currently handled by each worker thread, attached to its requests
+_context = threading.local()
+
+
+def initialize(
+    api_url,
+    api_key,
+    model_name,
+    max_inflight_requests=64,
+    rpm=None,
+    tpm=None,
+    tokenizer=None,
+    adaptive_concurrency=False,
+    min_inflight_requests=1,
+    timeout=120.0,
+    max_retries=5,
+    retry_budget=0.2,
+    stream_responses=False,
+    hedge_percentile=None,
+    hedge_max_rate=0.05,
+):
+    """
+    Start the client event loop and create the async OpenAI client
+
+    Args:
+        api_url: Base URL of the OpenAI-compatible API, or a list of URLs of equivalent replicas
+        api_key: API key
+        model_name: Model to use for all requests
+        max_inflight_requests: Run-wide cap on concurrent upstream requests
+        rpm: Requests-per-minute limit to stay under (None for no limit)
+        tpm: Tokens-per-minute limit to stay under (None for no limit)
+        tokenizer: Tokenizer used to estimate prompt tokens for the TPM limit
+        adaptive_concurrency: Adjust the in-flight limit with AIMD between
+            min_inflight_requests and max_inflight_requests
+        min_inflight_requests: Lower bound of the adaptive in-flight limit
+        timeout: Per-attempt request timeout in seconds
+        max_retries: Maximum number of retries of a single call on transient errors
+        retry_budget: Run-wide retries allowed per call made, on top of a fixed reserve
+        stream_responses: Stream responses, recording time-to-first-token and stopping
+            map calls as soon as they answer NO_INFORMATION
+        hedge_percentile: Send a duplicate of map calls slower than this latency percentile
+            of recent map calls (None for no hedging)
+        hedge_max_rate: Maximum hedged requests per map call
+    """
+    global client, endpoint_pool, _probe_future, stream, hedger
+    global model, loop, scheduler, rate_limiter, controller, retry_policy, request_timeout, max_inflight
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name="llm-client-loop", daemon=True)
+        thread.start()
+
+    api_urls = [api_url] if isinstance(api_url, str) else list(api_url)
+    endpoint_pool = EndpointPool([
+        Endpoint(url, create_client(url, api_key, max_inflight_requests)) for url in api_urls
+    ])
+    client = endpoint_pool.endpoints[0].client
+    if _probe_future is not None:
+        _probe_future.cancel()
+    _probe_future = None
+    if len(api_urls) > 1:
+        _probe_future = asyncio.run_coroutine_threadsafe(endpoint_pool.probe_forever(), loop)
+
+    model = model_name
+    max_inflight = max_inflight_requests
+    scheduler = PriorityScheduler(max_inflight_requests)
+    rate_limiter = RateLimiter(rpm=rpm, tpm=tpm, tokenizer=tokenizer)
+    retry_policy = RetryPolicy(max_retries=max_retries, budget_ratio=retry_budget)
+    request_timeout = timeout
+    stream = stream_responses
+    hedger = Hedger(percentile=hedge_percentile, max_rate=hedge_max_rate) if hedge_percentile else None
+    controller = None
+    if adaptive_concurrency:
+        controller = AIMDController(scheduler, min_limit=min_inflight_requests, max_limit=max_inflight_requests)
+
+
+def create_client(api_url, api_key, max_connections):
+    """Create an AsyncOpenAI client for one endpoint"""
+    return AsyncOpenAI(
+        base_url=api_url,
+        api_key=api_key,
+        max_retries=0,  # Retries are handled by retry_policy
+        http_client=httpx.AsyncClient(
+            base_url=api_url,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        ),
+    )
+
+
+def initialize_cache(path, max_size_mb=1024, read_only=False):
+    """
+    Serve repeated requests from a persistent response cache
+
+    Args:
+        path: SQLite database file
+        max_size_mb: Size bound of the cached responses, least recently used entries are evicted
+        read_only: Only read from the cache, never store new responses
+    """
+    global cache
+    cache = ResponseCache(path, max_size_mb=max_size_mb, read_only=read_only)
+
+
+def get_stats():
+    """Counters of the client layers for run reports"""
+    stats = {
+        "retries": retry_policy.retries,
+        "failed_calls": retry_policy.failures,
+        "singleflight_saved": singleflight.saved,
+        "rate_limit_wait": rate_limiter.throttled_time,
+        "usage": usage.totals("stage"),
+    }
+    if hedger:
+        stats.update(hedger.stats())
+    if controller:
+        stats["inflight_limit"] = int(controller.limit)
+    if stream:
+        stats["stream_early_stopped"] = stream_stats["early_stopped"]
+        stats["ttft"] = {
+            stage: stream_stats["ttft_total"][stage] / stream_stats["ttft_count"][stage]
+            for stage in stream_stats["ttft_count"]
+        }
+    if cache:
+        stats["cache"] = cache.stats()
+    if len(endpoint_pool.endpoints) > 1:
+        stats["endpoints"] = endpoint_pool.stats()
+    return stats
+
+
+def set_example_context(example_id, start_time=None):
+    """
+    Tag requests submitted from the current thread with the example being processed
+
+    Args:
+        example_id: Id of the example
+        start_time: When processing of the example started, used for FIFO ordering
+    """
+    _context.example_id = example_id
+    _context.start_time = time.time() if start_time is None else start_time
+    _context.iteration = None
+
+
+def set_iteration(iteration):
+    """Tag requests submitted from the current thread with the map-reduce iteration"""
+    _context.iteration = iteration
+
+
+def get_example_context():
+    """Return (example_id, start_time) for the current thread"""
+    return getattr(_context, "example_id", None), getattr(_context, "start_time", None)
+
+
+def default_temperature():
+    """Sampling temperature used for all pipeline calls"""
+    is_open_source_model = "llama" in model.lower()
+    return 0.1 if is_open_source_model else 0.0
+
+
+def set_generation_limits(stage, max_tokens=None, stop=None):
+    """
+    Configure the output token budget and stop sequences of a stage
+
+    Args:
+        stage: Pipeline stage ("map", "score", "reduce" or "postprocess")
+        max_tokens: Maximum output tokens, None or 0 for no limit
+        stop: List of stop sequences, None for none
+    """
+    generation_limits[stage] = {"max_tokens": max_tokens or None, "stop": stop or None}
+
+
+def build_request(messages, stage="map", limits=None):
+    """
+    Body of the chat completion request for a pipeline call
+
+    The same body is used for online calls, batch files and cache keys.
+
+    Args:
+        messages: Chat messages to send
+        stage: Pipeline stage of the call, selects the generation limits
+        limits: Optional overrides of the stage limits, e.g. {"max_tokens": None}
+
+    Returns:
+        Dict of chat.completions.create keyword arguments
+    """
+    body = {
+        "model": model,
+        "messages": messages,
+        "temperature": default_temperature(),
+    }
+    params = dict(generation_limits.get(stage, {}))
+    params.update(limits or {})
+    for name, value in params.items():
+        if value is not None:
+            body[name] = value
+    return body
+
+
+def prefill(responses):
+    """
+    Serve the given responses instead of calling the API, e.g. results of a batch job
+
+    Args:
+        responses: Dict mapping make_key(**body) to response content
+    """
+    prefilled.update(responses)
+    if cache:
+        for key, content in responses.items():
+            cache.put(key, content)
+
+
+def run(coro):
+    """Run a coroutine on the client event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def get_content(completion):
+    """Return the message content of a completion, or None if it is incomplete"""
+    if (
+        hasattr(completion, 'choices') and
+        len(completion.choices) > 0 and
+        hasattr(completion.choices[0], 'message') and
+        completion.choices[0].message and
+        hasattr(completion.choices[0].message, 'content') and
+        completion.choices[0].message.content
+    ):
+        return completion.choices[0].message.content
+    return None
+
+
+async def achat(
+    messages: list, stage="map", example_start=None, estimated_tokens=None, affinity=None, limits=None, tags=None
+):
+    """
+    Coroutine version of chat, must be awaited on the client event loop
+
+    Args:
+        messages: Chat messages to send
+        stage: Pipeline stage of the call ("map", "score", "reduce" or "postprocess")
+        example_start: Start time of the owning example, requests of older examples go first
+        estimated_tokens: Precomputed rate limiter cost of the request
+        affinity: Optional routing key, e.g. (example id, chunk id), equal keys prefer the same endpoint
+        limits: Optional overrides of the stage generation limits
+        tags: Optional {"example_id", "iteration"} recorded with the token usage
+
+    Returns:
+        Content of the model response
+    """
+    body = build_request(messages, stage, limits)
+    key = make_key(**body)
+    content = prefilled.get(key)
+    if content is not None:
+        return content
+    if cache:
+        # SQLite access blocks, keep it off the event loop every request runs on
+        content = await asyncio.to_thread(cache.get, key)
+        if content is not None:
+            return content
+
+    async def fetch():
+        content = await _request(body, stage, example_start, estimated_tokens, affinity, tags)
+        if cache:
+            await asyncio.to_thread(cache.put, key, content)
+        return content
+
+    return await singleflight.do(key, fetch)
+
+
+async def _request(body, stage, example_start, estimated_tokens, affinity=None, tags=None):
+    """Send one chat request upstream, with scheduling, rate limiting and retries"""
+    if example_start is None:
+        example_start = time.time()
+    if estimated_tokens is None:
+        estimated_tokens = rate_limiter.estimate_tokens(body["messages"], body.get("max_tokens"))
+    retry_policy.on_call()
+
+    async def attempt_once(sent=None, hedge=False):
+        # A hedge is routed by load alone, the affine endpoint is the one being slow
+        return await _attempt(body, stage, example_start, estimated_tokens, None if hedge else affinity, sent, tags)
+
+    attempt = 0
+    while True:
+        try:
+            if hedger and stage in hedger.stages:
+                return await hedger.run(stage, attempt_once)
+            return await attempt_once()
+        except Exception as e:
+            attempt += 1
+            if not retry_policy.should_retry(e, attempt):
+                raise
+            delay = retry_policy.backoff(attempt, e)
+            print(f"Error occurred: {e}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def _attempt(body, stage, example_start, estimated_tokens, affinity=None, sent=None, tags=None):
+    """One upstream attempt of a request, sets the event `sent` once it leaves the queue"""
+    # Take the rate limit budget first, so throttled requests wait in priority order without holding a slot
+    await rate_limiter.acquire(estimated_tokens, stage, example_start)
+    async with scheduler.slot(stage, example_start):
+        endpoint = endpoint_pool.pick(affinity)
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        started = time.monotonic()
+        if sent is not None:
+            sent.set()
+        try:
+            content = await _create(endpoint, body, stage, started, tags, estimated_tokens)
+            if not content:
+                raise IncompleteResponseError("Received incomplete response")
+        except Exception as e:
+            endpoint_pool.on_error(endpoint, e)
+            if controller:
+                controller.on_error(started, e)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        endpoint_pool.on_success(endpoint)
+        if controller:
+            controller.on_success(stage, started, time.monotonic() - started)
+    return content
+
+
+def record_usage(stage, completion_usage, tags=None, estimated=False):
+    """
+    Record the token usage of a call
+
+    Args:
+        stage: Pipeline stage of the call
+        completion_usage: The `usage` object of a completion or of the last streamed chunk
+        tags: Optional {"example_id", "iteration"} of the call
+        estimated: Whether the usage is a client-side estimate rather than reported by the API
+    """
+    usage.record(stage, completion_usage, estimated=estimated, **(tags or {}))
+
+
+async def _create(endpoint, body, stage, started, tags=None, estimated_tokens=None):
+    """Send one request to an endpoint and return the response content"""
+    if not stream:
+        completion = await endpoint.client.chat.completions.create(**body, timeout=request_timeout)
+        record_usage(stage, getattr(completion, "usage", None), tags)
+        return get_content(completion)
+
+    response = await endpoint.client.chat.completions.create(
+        **body, stream=True, stream_options={"include_usage": True}, timeout=request_timeout
+    )
+    parts = []
+    reported = False
+    # Only map outputs are checked for the marker, and only until they diverge from it
+    checking = stage == "map"
+    try:
+        async for chunk in response:
+            # Usage arrives in a final chunk without choices, early-stopped streams never see it
+            if getattr(chunk, "usage", None) is not None:
+                record_usage(stage, chunk.usage, tags)
+                reported = True
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if not parts:
+                stream_stats["ttft_total"][stage] = stream_stats["ttft_total"].get(stage, 0.0) + time.monotonic() - started
+                stream_stats["ttft_count"][stage] = stream_stats["ttft_count"].get(stage, 0) + 1
+            parts.append(chunk.choices[0].delta.content)
+            if checking:
+                text = "".join(parts).lstrip().upper()
+                if text.startswith(NO_INFORMATION):
+                    # Free the connection and the decode slot instead of reading trailing text
+                    stream_stats["early_stopped"] += 1
+                    break
+                checking = NO_INFORMATION.startswith(text)
+    finally:
+        await response.close()
+    if not reported:
+        # Still account for the call: the rate limiter's prompt estimate plus one token per streamed delta
+        if estimated_tokens is None:
+            estimated_tokens = rate_limiter.estimate_tokens(body["messages"], body.get("max_tokens"))
+        prompt_tokens = estimated_tokens - (body.get("max_tokens") or rate_limiter.default_max_tokens)
+        record_usage(stage, {"prompt_tokens": prompt_tokens, "completion_tokens": len(parts)}, tags, estimated=True)
+    return "".join(parts)
+
+
+def submit(messages: list, stage="map", affinity=None, limits=None):
+    """
+    Schedule a chat request from any thread without blocking
+
+    Args:
+        messages: Chat messages to send
+        stage: Pipeline stage of the call
+        affinity: Optional endpoint routing key
+        limits: Optional overrides of the stage generation limits
+
+    Returns:
+        concurrent.futures.Future resolving to the response content
+    """
+    example_id, example_start = get_example_context()
+    tags = {"example_id": example_id, "iteration": getattr(_context, "iteration", None)}
+    # Token counting is CPU work, do it on the calling thread rather than the event loop
+    max_tokens = build_request(messages, stage, limits).get("max_tokens")
+    estimated_tokens = rate_limiter.estimate_tokens(messages, max_tokens)
+    return asyncio.run_coroutine_threadsafe(
+        achat(
+            messages,
+            stage=stage,
+            example_start=example_start,
+            estimated_tokens=estimated_tokens,
+            affinity=affinity,
+            limits=limits,
+            tags=tags,
+        ),
+        loop,
+    )
+
+
+def chat(messages: list, stage="map", limits=None):
+    """Blocking chat call, safe to use from worker threads (not from the client loop)"""
+    return submit(messages, stage=stage, limits=limits).result()
+
+
+def chat_many(messages_list, concurrency=None, stage="map", affinity_keys=None, limits=None):
+    """
+    Send several chat requests at once and wait for all of them
+
+    Args:
+        messages_list: Iterable of chat message lists, each request is sent as soon as
+            its messages are produced (e.g. by a generator still chunking the context)
+        concurrency: Maximum number of these requests in flight at once (None or 0 for no limit)
+        stage: Pipeline stage of the calls
+        affinity_keys: Optional iterable of endpoint routing keys, one per request
+        limits: Optional iterable of generation limit overrides, one per request
+
+    Returns:
+        List of response contents in the same order as messages_list
+    """
+    limit = threading.BoundedSemaphore(concurrency) if concurrency else None
+    affinities = iter(affinity_keys) if affinity_keys is not None else None
+    overrides = iter(limits) if limits is not None else None
+    futures = []
+    try:
+        for messages in messages_list:
+            if limit:
+                limit.acquire()
+            affinity = next(affinities, None) if affinities is not None else None
+            request_limits = next(overrides, None) if overrides is not None else None
+            future = submit(messages, stage=stage, affinity=affinity, limits=request_limits)
+            if limit:
+                future.add_done_callback(lambda _: limit.release())
+            futures.append(future)
+        return [future.result() for future in futures]
+    except Exception:
+        # One failed call fails the whole batch, don't keep paying for the rest
+        for future in futures:
+            future.cancel()
+        raise
@@ -0,0 +1,635 @@
+"""
+Local OpenAI-compatible stand-in server for offline runs
+
+Implements /v1/models, /v1/chat/completions (plain and streamed) and the Batch API endpoints
+(/v1/files, /v1/files/{id}/content, /v1/batches, /v1/batches/{id}) with an
+in-memory store. Usage:
+
+    python -m src.mock_server --port 8000 --data_path ./data/rag_1000k.jsonl --latency lognormal:0.8,0.5
+    python main.py --api_url http://127.0.0.1:8000/v1 --api_key mock ...
+
+Responses are scripted from the prompts in src/prompt.py: map calls report the
+gold answer when their chunk contains it (or, without --data_path, a sentence
+of the chunk for a seeded fraction of chunks), score calls rate extracted
+information that contains the answer high (fused map calls asking for JSON
+answer with the information, its flag and such a score), and reduce calls
+answer once the extracted information contains it. Latency, 5xx errors and 429s are drawn
+from a generator seeded by --seed, the request body and its attempt number,
+so the same run sees the same behaviour whatever the request interleaving.
+"""
+import argparse
+import collections
+import email.parser
+import email.policy
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NO_INFORMATION = "NO INFORMATION"
+NO_ANSWER = "NO ANSWER"
+# Characters per block of the simulated prefix cache
+PREFIX_BLOCK = 256
+LATENCY_KINDS = ("fixed", "uniform", "lognormal", "exponential")
+
+
+def parse_latency(spec):
+    """
+    Parse a latency distribution spec
+
+    Args:
+        spec: "fixed:S", "uniform:LOW,HIGH", "lognormal:MEDIAN,SIGMA" or "exponential:MEAN", in seconds
+
+    Returns:
+        (kind, params) tuple
+    """
+    kind, _, params = spec.partition(":")
+    if kind not in LATENCY_KINDS:
+        raise ValueError(f"Unknown latency distribution {kind!r}, expected one of {', '.join(LATENCY_KINDS)}")
+    values = [float(value) for value in params.split(",") if value.strip()]
+    expected = {"fixed": 1, "uniform": 2, "lognormal": 2, "exponential": 1}[kind]
+    if len(values) != expected:
+        raise ValueError(f"Latency distribution {kind} takes {expected} parameter(s), got {spec!r}")
+    return kind, values
+
+
+def sample_latency(latency, rng):
+    """Draw a delay in seconds from a parsed latency distribution"""
+    kind, values = latency
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return values[0] * rng.lognormvariate(0.0, values[1])
+    return rng.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0
+
+
+def classify_prompt(prompt):
+    """Which pipeline stage a user prompt from src/prompt.py belongs to"""
+    if "provide a score (0-100)" in prompt or "给出一个分数" in prompt:
+        return "score"
+    if "Please condense the following answer" in prompt:
+        return "postprocess"
+    if prompt.startswith("We have the following extracted information") or prompt.startswith("我们有以下从不同文本块中提取的信息"):
+        return "reduce"
+    return "map"
+
+
+def _between(text, starts, ends):
+    """Text after the first of `starts` found and before the first following end marker"""
+    for start in starts:
+        pos = text.find(start)
+        if pos >= 0:
+            text = text[pos + len(start):]
+            break
+    cut = [text.find(end) for end in ends if end in text]
+    return text[:min(cut)] if cut else text
+
+
+def _last_question(prompt):
+    matches = re.findall(r"(?:Question: |问题：)(.*)", prompt)
+    return matches[-1].strip() if matches else ""
+
+
+def load_answers(path):
+    """
+    Map questions to gold answers from a pipeline data file
+
+    Args:
+        path: JSONL file with question/input and answer/answers/outputs fields
+
+    Returns:
+        Dict mapping question text to a list of answer strings
+    """
+    answers = {}
+    with open(path, "r", encoding="utf8") as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+            eg = json.loads(line)
+            question = eg.get("question", eg.get("input", ""))
+            answer = eg.get("answer", eg.get("answers", eg.get("outputs")))
+            if answer is None:
+                continue
+            answer = answer if isinstance(answer, list) else [answer]
+            answers[question.strip()] = [str(value) for value in answer if str(value).strip()]
+    return answers
+
+
+class MockBackend:
+    """In-memory state of the stand-in server"""
+
+    def __init__(
+        self,
+        response=None,
+        batch_delay=1.0,
+        token_delay=0.01,
+        latency="fixed:0",
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        max_concurrency=0,
+        retry_after=1.0,
+        answers=None,
+        hit_rate=0.1,
+        answer_rate=1.0,
+        seed=0,
+    ):
+        """
+        Args:
+            response: Fixed response text for every request, None for scripted responses
+            batch_delay: Seconds a batch stays in progress
+            token_delay: Seconds between streamed words
+            latency: Latency distribution spec, see parse_latency
+            error_rate: Fraction of requests answered with HTTP 500
+            rate_limit_rate: Fraction of requests answered with HTTP 429
+            max_concurrency: Answer HTTP 429 above this many concurrent requests, 0 for no limit
+            retry_after: Retry-After seconds sent with 429 responses
+            answers: Dict mapping questions to gold answers, see load_answers
+            hit_rate: Fraction of chunks reported as relevant when the answers are unknown
+            answer_rate: Fraction of non-final reduce calls that answer from relevant information
+                when the answers are unknown, lower values make examples run more iterations
+            seed: Seed for latencies, injected errors and scripted responses
+        """
+        self.response = response
+        self.batch_delay = batch_delay
+        self.token_delay = token_delay
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.answers = answers or {}
+        self.hit_rate = hit_rate
+        self.answer_rate = answer_rate
+        self.seed = seed
+        self.files = {}
+        self.batches = {}
+        self.active = 0
+        self.counts = collections.Counter()
+        self._attempts = collections.Counter()
+        self._prefix_blocks = set()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def new_id(self, prefix):
+        with self._lock:
+            return f"{prefix}-{next(self._ids)}"
+
+    def _digest(self, body):
+        data = json.dumps(body.get("messages", []), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+    def _rng(self, *parts):
+        return random.Random("|".join(str(part) for part in (self.seed,) + parts))
+
+    def admit(self):
+        """Count a request as active, False when it exceeds max_concurrency"""
+        with self._lock:
+            if self.max_concurrency and self.active >= self.max_concurrency:
+                self.counts["status_429"] += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def plan(self, body):
+        """
+        Decide how to answer a request, seeded by the body and its attempt number
+
+        Args:
+            body: Chat completion request body
+
+        Returns:
+            (status, delay) tuple, status 200 for a completion after `delay` seconds
+        """
+        digest = self._digest(body)
+        with self._lock:
+            self._attempts[digest] += 1
+            attempt = self._attempts[digest]
+        rng = self._rng(digest, attempt)
+        draw = rng.random()
+        if draw < self.error_rate:
+            status = 500
+        elif draw < self.error_rate + self.rate_limit_rate:
+            status = 429
+        else:
+            status = 200
+        delay = sample_latency(self.latency, rng) if status == 200 else 0.0
+        with self._lock:
+            self.counts[f"status_{status}"] += 1
+        return status, delay
+
+    def generate(self, body):
+        """Response text for a chat completion request body"""
+        if self.response is not None:
+            return self.response
+        messages = body.get("messages", [])
+        prompt = str(messages[-1].get("content", "")) if messages else ""
+        stage = classify_prompt(prompt)
+        with self._lock:
+            self.counts[stage] += 1
+        answers = self.answers.get(_last_question(prompt))
+        rng = self._rng(self._digest(body))
+
+        if stage == "score":
+            def score(info):
+                if answers is not None:
+                    relevant = _find_answer(info, answers) is not None
+                else:
+                    relevant = NO_INFORMATION not in info and bool(info.strip())
+                return rng.randint(80, 100) if relevant else rng.randint(0, 20)
+
+            if prompt.startswith("Below are ") or prompt.startswith("以下是从长文本"):
+                # Batched scoring, numbered items "[N] info" before the question
+                items = _between(prompt, ["\n\n"], ["\n\nQuestion: ", "\n\n问题："])
+                infos = re.split(r"(?:^|\n\n)\[\d+\] ", items)[1:]
+                return "\n".join(f"{number}. Score: {score(info)}" for number, info in enumerate(infos, start=1))
+            info = _between(prompt, ["Extracted information: ", "提取的信息："], ["\n\nQuestion: ", "\n\n问题："])
+            return f"Score: {score(info)}"
+
+        if stage == "postprocess":
+            return _between(prompt, ["Answer: "], ["\n"]).strip()
+
+        if stage == "reduce":
+            info = _between(
+                prompt,
+                ["text:\n\n", "信息：\n\n"],
+                ["\n\nBased on the extracted information", "\n\n根据提取的信息"],
+            )
+            if answers is not None:
+                found = _find_answer(info, answers)
+            elif "Relevant: " in info and (NO_ANSWER not in prompt or rng.random() < self.answer_rate):
+                found = _between(info, ["Relevant: "], ["\n", "."]).strip()
+            else:
+                found = None
+            if found:
+                return found
+            return NO_ANSWER
+
+        # Map calls, first iteration or later: only look inside the chunk itself
+        chunk = prompt.split("\n\n", 1)[-1]
+        chunk = _between(chunk, ["Your chunk:\n", "你的文本块：\n"], [
+            "\n\nPreviously extracted information", "\n\n先前提取的信息", "\n\nQuestion: ", "\n\n问题：",
+        ])
+        if answers is not None:
+            found = _find_answer(chunk, answers)
+            information = f"The chunk states that the answer is {found}." if found else NO_INFORMATION
+        elif rng.random() < self.hit_rate:
+            sentence = chunk.strip().split(". ")[0][:200]
+            information = f"Relevant: {sentence}."
+        else:
+            information = NO_INFORMATION
+        if "\"has_information\"" not in prompt:
+            return information
+        # Fused map call (--map_output json*): the information, its flag and a score as JSON
+        has_information = information != NO_INFORMATION
+        answer = {"information": information, "has_information": has_information}
+        if "\"score\"" in prompt:
+            answer["score"] = rng.randint(80, 100) if has_information else rng.randint(0, 20)
+        return json.dumps(answer, ensure_ascii=False)
+
+    def stats(self):
+        """Request counts by stage and response status"""
+        with self._lock:
+            return dict(self.counts)
+
+    def cached_prefix(self, body):
+        """
+        Characters of the prompt found in a simulated prefix cache, block by block like vLLM
+
+        Args:
+            body: Chat completion request body, its blocks are added to the cache
+
+        Returns:
+            Number of leading prompt characters that were already cached
+        """
+        text = "".join(f"{message.get('role')}\n{message.get('content', '')}\n" for message in body.get("messages", []))
+        digest = hashlib.sha256(str(body.get("model")).encode("utf8"))
+        cached, hit = 0, True
+        with self._lock:
+            for start in range(0, len(text) - PREFIX_BLOCK + 1, PREFIX_BLOCK):
+                digest.update(text[start:start + PREFIX_BLOCK].encode("utf8"))
+                block = digest.digest()
+                if hit and block in self._prefix_blocks:
+                    cached += PREFIX_BLOCK
+                else:
+                    hit = False
+                    self._prefix_blocks.add(block)
+        return cached
+
+    def complete(self, body):
+        """Chat completion object for a request body"""
+        content = self.generate(body)
+        prompt_tokens = sum(len(str(message.get("content", ""))) // 4 for message in body.get("messages", []))
+        cached_tokens = min(prompt_tokens, self.cached_prefix(body) // 4)
+        completion_tokens = max(1, len(content) // 4)
+        return {
+            "id": self.new_id("chatcmpl"),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    def add_file(self, filename, data, purpose):
+        file_id = self.new_id("file")
+        self.files[file_id] = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+            "data": data,
+        }
+        return self.files[file_id]
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = self.new_id("batch")
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self.batches[batch_id] = batch
+        threading.Thread(target=self._process_batch, args=(batch,), daemon=True).start()
+        return batch
+
+    def _process_batch(self, batch):
+        lines = self.files[batch["input_file_id"]]["data"].decode("utf8").splitlines()
+        requests = [json.loads(line) for line in lines if line.strip()]
+        batch["request_counts"]["total"] = len(requests)
+        batch["status"] = "in_progress"
+        time.sleep(self.batch_delay)
+
+        output = []
+        for request in requests:
+            record = {"id": self.new_id("batch_req"), "custom_id": request["custom_id"], "error": None}
+            try:
+                status, _ = self.plan(request["body"])
+                if status != 200:
+                    raise RuntimeError(f"Injected error {status}")
+                record["response"] = {
+                    "status_code": 200,
+                    "request_id": self.new_id("req"),
+                    "body": self.complete(request["body"]),
+                }
+                batch["request_counts"]["completed"] += 1
+            except Exception as e:
+                record["response"] = None
+                record["error"] = {"code": "server_error", "message": str(e)}
+                batch["request_counts"]["failed"] += 1
+            output.append(json.dumps(record, ensure_ascii=False))
+
+        data = ("\n".join(output) + "\n").encode("utf8")
+        batch["output_file_id"] = self.add_file(f"{batch['id']}_output.jsonl", data, "batch_output")["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+
+def _find_answer(text, answers):
+    """The first answer that occurs in text, ignoring case, or None"""
+    lowered = text.lower()
+    for answer in answers:
+        if answer.lower() in lowered:
+            return answer
+    return None
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    backend = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf8")
+        self._send_body(status, data)
+
+    def send_error_json(self, status, message, headers=None):
+        data = json.dumps({"error": {"message": message, "type": "mock_error", "code": status}}).encode("utf8")
+        self._send_body(status, data, headers)
+
+    def _send_body(self, status, data, headers=None):
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the request (cancelled or hedged)
+            pass
+
+    def send_stream(self, completion, include_usage=False):
+        """Send a completion as server-sent chat.completion.chunk events, one word at a time"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        content = completion["choices"][0]["message"]["content"]
+        words = content.split(" ")
+        try:
+            for idx, word in enumerate(words):
+                delta = {"content": word if idx == 0 else " " + word}
+                if idx == 0:
+                    delta["role"] = "assistant"
+                chunk = {
+                    "id": completion["id"],
+                    "object": "chat.completion.chunk",
+                    "created": completion["created"],
+                    "model": completion["model"],
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf8"))
+                self.wfile.flush()
+                time.sleep(self.backend.token_delay)
+            final = {
+                "id": completion["id"],
+                "object": "chat.completion.chunk",
+                "created": completion["created"],
+                "model": completion["model"],
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            self.wfile.write(f"data: {json.dumps(final)}\n\n".encode("utf8"))
+            if include_usage:
+                usage = dict(final, choices=[], usage=completion["usage"])
+                self.wfile.write(f"data: {json.dumps(usage)}\n\n".encode("utf8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early
+            pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        parts = path.split("/")
+        if path.endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}]})
+        elif len(parts) >= 2 and parts[-1] == "content" and parts[-2] in self.backend.files:
+            data = self.backend.files[parts[-2]]["data"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif parts[-1] in self.backend.batches:
+            self.send_json(200, self.backend.batches[parts[-1]])
+        elif parts[-1] in self.backend.files:
+            self.send_json(200, {k: v for k, v in self.backend.files[parts[-1]].items() if k != "data"})
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        raw = self.read_body()
+        if path.endswith("/chat/completions"):
+            body = json.loads(raw)
+            if not self.backend.admit():
+                self.send_error_json(429, "Too many concurrent requests", {"Retry-After": str(self.backend.retry_after)})
+                return
+            try:
+                self.answer_chat(body)
+            finally:
+                self.backend.release()
+        elif path.endswith("/files"):
+            filename, data, purpose = self.parse_upload(raw)
+            file_obj = self.backend.add_file(filename, data, purpose)
+            self.send_json(200, {k: v for k, v in file_obj.items() if k != "data"})
+        elif path.endswith("/batches"):
+            body = json.loads(raw)
+            if body.get("input_file_id") not in self.backend.files:
+                self.send_error_json(400, "Unknown input_file_id")
+                return
+            batch = self.backend.create_batch(body["input_file_id"], body["endpoint"], body["completion_window"])
+            self.send_json(200, batch)
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+
+    def answer_chat(self, body):
+        status, delay = self.backend.plan(body)
+        if status == 429:
+            self.send_error_json(429, "Injected rate limit", {"Retry-After": str(self.backend.retry_after)})
+            return
+        if status != 200:
+            self.send_error_json(status, "Injected server error")
+            return
+        time.sleep(delay)
+        completion = self.backend.complete(body)
+        if body.get("stream"):
+            self.send_stream(completion, include_usage=(body.get("stream_options") or {}).get("include_usage", False))
+        else:
+            self.send_json(200, completion)
+
+    def parse_upload(self, raw):
+        """Extract (filename, data, purpose) from a multipart/form-data file upload"""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf8")
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + raw)
+        filename, data, purpose = "upload.jsonl", b"", "batch"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                filename = part.get_filename() or filename
+                data = part.get_payload(decode=True)
+            elif name == "purpose":
+                purpose = part.get_payload(decode=True).decode("utf8")
+        return filename, data, purpose
+
+
+class MockServer(ThreadingHTTPServer):
+    # The default backlog of 5 makes concurrent clients wait for SYN retries
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve(host="127.0.0.1", port=8000, backend=None):
+    """
+    Create the stand-in server, call serve_forever() on the result to run it
+
+    Args:
+        host: Interface to bind
+        port: Port to bind, 0 picks a free port
+        backend: MockBackend holding the server state and responses
+    """
+    handler = type("Handler", (MockHandler,), {"backend": backend or MockBackend()})
+    return MockServer((host, port), handler)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--response", type=str, default=None, help="Fixed response for every request instead of scripted ones")
+    parser.add_argument("--data_path", type=str, default=None, help="Pipeline data file whose answers drive the scripted responses")
+    parser.add_argument("--hit_rate", type=float, default=0.1)
+    parser.add_argument("--answer_rate", type=float, default=1.0)
+    parser.add_argument("--latency", type=str, default="fixed:0", help="fixed:S, uniform:LOW,HIGH, lognormal:MEDIAN,SIGMA or exponential:MEAN")
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--max_concurrency", type=int, default=0)
+    parser.add_argument("--retry_after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_delay", type=float, default=1.0)
+    parser.add_argument("--token_delay", type=float, default=0.01)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    backend = MockBackend(
+        response=args.response,
+        batch_delay=args.batch_delay,
+        token_delay=args.token_delay,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        max_concurrency=args.max_concurrency,
+        retry_after=args.retry_after,
+        answers=load_answers(args.data_path) if args.data_path else None,
+        hit_rate=args.hit_rate,
+        answer_rate=args.answer_rate,
+        seed=args.seed,
+    )
+    server = serve(args.host, args.port, backend)
+    print(f"Mock OpenAI server listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Mock server requests: {json.dumps(backend.stats(), sort_keys=True)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,203 @@
+import collections
+import itertools
+import json
+import multiprocessing
 import time
 import re
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 
+from . import batch
 from . import prompt as prompt_module
+from . import usage as usage_module
 from . import utils
 
-def process_example(i, examples, tokenizer, task, chunk_length, input_length, max_iterations=5):
+
+def get_example_chunks(eg, tokenizer, task, chunk_length, input_length, chunk_mode="token", stream=False):
+    """
+    Split the context of an example into chunks the way process_example does
+
+    With stream=True, an iterator yielding the chunks while the context is
+    still being encoded (utils.iter_chunks) is returned instead of a list.
+    """
+    manner = "front" if task == "rag" else "middle"
+    return (utils.iter_chunks if stream else utils.create_chunks)(
+        tokenizer=tokenizer,
+        context=eg["context"],
+        chunk_length=chunk_length,
+        input_length=input_length,
+        manner=manner,
+        token_cache=utils.token_cache,
+        chunk_mode=chunk_mode,
+    )
+
+
+# Tokenizer of a chunking worker process, set by _init_chunk_worker
+_chunk_tokenizer = None
+
+
+def _init_chunk_worker(tokenizer, token_cache_args):
+    global _chunk_tokenizer
+    _chunk_tokenizer = tokenizer
+    if token_cache_args:
+        utils.initialize_token_cache(*token_cache_args)
+
+
+def _chunk_in_worker(context, task, chunk_length, input_length, chunk_mode):
+    return get_example_chunks({"context": context}, _chunk_tokenizer, task, chunk_length, input_length, chunk_mode)
+
+
+def iter_example_chunks(
+    examples, ids, tokenizer, task, chunk_length, input_length, num_workers, prefetch, chunk_mode="token"
+):
+    """
+    Chunk examples in a process pool, running ahead of the consumer
+    
+    Tokenization is CPU-bound, so doing it in separate processes keeps it from
+    competing with the request threads for the GIL.
+    
+    Args:
+        examples: List of examples
+        ids: Indices of the examples to chunk, in the order they are needed
+        tokenizer: Tokenizer for text encoding/decoding, sent once to each worker process
+        task: Task type ("en", "zh", or "rag")
+        chunk_length: Length of each text chunk
+        input_length: Maximum input length to consider
+        num_workers: Number of worker processes
+        prefetch: Maximum number of examples chunked ahead of the consumer
+        chunk_mode: How the context is cut, one of utils.CHUNK_MODES
+        
+    Yields:
+        (example index, list of chunks) in the order of ids, chunks are None if chunking failed
+    """
+    token_cache = utils.token_cache
+    token_cache_args = (str(token_cache.path), token_cache.read_only) if token_cache is not None else None
+    # The parent runs the LLM client thread, so don't fork it
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_chunk_worker,
+        initargs=(tokenizer, token_cache_args),
+    ) as pool:
+        ids = iter(ids)
+        pending = collections.deque()
+
+        def submit_next(count):
+            for i in itertools.islice(ids, count):
+                future = pool.submit(
+                    _chunk_in_worker, examples[i]["context"], task, chunk_length, input_length, chunk_mode
+                )
+                pending.append((i, future))
+
+        submit_next(max(prefetch, 1))
+        while pending:
+            i, future = pending.popleft()
+            submit_next(1)
+            try:
+                chunks = future.result()
+            except Exception as e:
+                print(f"Chunking example {i} failed: {e}")
+                chunks = None
+            yield i, chunks
+
+
+def prefill_with_batch(
+    examples, ids, tokenizer, task, chunk_length, input_length, output_dir, poll_interval=30.0, prompt_layout="default",
+    tokenize_workers=0, chunk_mode="token", score_batch_tokens=0, map_output="text",
+):
+    """
+    Run the first-iteration map (and score) calls of all pending examples through the Batch API
+    
+    The results are prefilled into the LLM client, so the following online
+    run of process_example gets them without calling the API again.
+    
+    Args:
+        examples: List of examples
+        ids: Indices of the examples to process
+        tokenizer: Tokenizer for text encoding/decoding
+        task: Task type ("en", "zh", or "rag")
+        chunk_length: Length of each text chunk
+        input_length: Maximum input length to consider
+        output_dir: Directory for the batch input and output files
+        poll_interval: Seconds between batch status checks
+        prompt_layout: Layout of the map prompts, one of prompt_module.PROMPT_LAYOUTS
+        tokenize_workers: Number of processes to chunk the examples in, 0 to chunk them in this thread
+        chunk_mode: How the context is cut, one of utils.CHUNK_MODES
+        score_batch_tokens: Token budget of the infos scored per call, 0 for one score call per info
+        map_output: Output format of the map calls, one of prompt_module.MAP_OUTPUTS; fused map
+            calls score the information themselves, so no score calls are batched
+    """
+    questions = {}
+    map_requests = {}
+    map_limits = utils.map_output_limits(task, prompt_module, map_output)
+    if tokenize_workers:
+        example_chunks = iter_example_chunks(
+            examples, ids, tokenizer, task, chunk_length, input_length, tokenize_workers, prefetch=2 * tokenize_workers,
+            chunk_mode=chunk_mode,
+        )
+    else:
+        example_chunks = ((i, None) for i in ids)
+    for i, chunks in example_chunks:
+        eg = examples[i]
+        question = eg.get("question", eg.get("input", ""))
+        questions[i] = question
+        if chunks is None:
+            chunks = get_example_chunks(eg, tokenizer, task, chunk_length, input_length, chunk_mode)
+        for chunk_id, chunk in enumerate(chunks):
+            prompt = prompt_module.create_first_iteration_prompt(task, chunk, question, layout=prompt_layout)
+            prompt = prompt_module.add_map_output_instruction(prompt, task, map_output)
+            msgs = prompt_module.create_chunked_msgs(prompt)
+            map_requests[f"map-{i}-{chunk_id}"] = utils.build_request(msgs, stage="map", limits=map_limits)
+
+    print(f"Running {len(map_requests)} map requests as a batch...")
+    map_usage = {}
+    map_results = batch.run_batch(map_requests, output_dir / "batch_map.jsonl", poll_interval=poll_interval, usage=map_usage)
+    utils.prefill_responses(map_requests, map_results)
+    for custom_id, usage in map_usage.items():
+        utils.record_usage("map", usage, example_id=int(custom_id.split("-")[1]), iteration=1, batch=True)
+
+    if task in ["en", "zh"] and map_output == "text":
+        score_requests = {}
+        if score_batch_tokens:
+            # The batched score calls process_example makes, for examples whose map calls all succeeded
+            example_infos = collections.defaultdict(list)
+            for custom_id in map_requests:
+                example_infos[int(custom_id.split("-")[1])].append(map_results.get(custom_id))
+            for i, infos in example_infos.items():
+                if None in infos:
+                    continue
+                requests = utils.build_score_batches(
+                    infos, questions[i], task, prompt_module, score_batch_tokens, tokenizer=tokenizer
+                )
+                for batch_id, (group, msgs, limits) in enumerate(requests):
+                    score_requests[f"score-{i}-{batch_id}"] = utils.build_request(msgs, stage="score", limits=limits)
+        else:
+            for custom_id, info in map_results.items():
+                _, i, chunk_id = custom_id.split("-")
+                prompt = prompt_module.get_info_score_prompt(info, questions[int(i)], task)
+                msgs = prompt_module.create_chunked_msgs(prompt)
+                score_requests[f"score-{i}-{chunk_id}"] = utils.build_request(msgs, stage="score")
+
+        print(f"Running {len(score_requests)} score requests as a batch...")
+        score_usage = {}
+        score_results = batch.run_batch(
+            score_requests, output_dir / "batch_score.jsonl", poll_interval=poll_interval, usage=score_usage
+        )
+        utils.prefill_responses(score_requests, score_results)
+        for custom_id, usage in score_usage.items():
+            utils.record_usage("score", usage, example_id=int(custom_id.split("-")[1]), iteration=1, batch=True)
+
+def _collect(iterable, into):
+    """Yield the items of iterable, appending each to the list into"""
+    for item in iterable:
+        into.append(item)
+        yield item
+
+
+def process_example(
+    i, examples, tokenizer, task, chunk_length, input_length, max_iterations=5, chunk_concurrency=None, prompt_layout="default",
+    chunks=None, chunk_mode="token", score_batch_tokens=0, map_output="text",
+):
     """
     Complete pipeline for processing a single example
     
@@ -23,6 +214,12 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
         chunk_length: Length of each text chunk
         input_length: Maximum input length to consider
         max_iterations: Maximum number of iterations
+        chunk_concurrency: Maximum number of chunk requests in flight for this example (None or 0 for all at once)
+        prompt_layout: Layout of the map prompts, one of prompt_module.PROMPT_LAYOUTS
+        chunks: Chunks of the example's context if already computed, e.g. by iter_example_chunks
+        chunk_mode: How the context is cut, one of utils.CHUNK_MODES
+        score_batch_tokens: Token budget of the infos scored per call, 0 for one score call per info
+        map_output: Output format of the map calls, one of prompt_module.MAP_OUTPUTS
         
     Returns:
         Processing result tuple (id, final prediction, info list, map stage time, reduce stage time)
@@ -39,61 +236,89 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
     
     # Variables specific to RAG task
     filtered_info = []
+    # Whether each entry of current_info holds information, for the RAG task
+    info_flags = []
     
     print(f"Processing example {i}...")
+    utils.set_example_context(id)
     
-    # Get text chunks using utils.create_chunks
-    manner = "front" if task == "rag" else "middle"
-    chunks = utils.create_chunks(
-        tokenizer=tokenizer,
-        context=context,
-        chunk_length=chunk_length,
-        input_length=input_length,
-        manner=manner
-    )
+    # Without precomputed chunks, the context is chunked while the first map calls are in flight
+    chunk_stream = None
+    if chunks is None:
+        chunk_stream = get_example_chunks(eg, tokenizer, task, chunk_length, input_length, chunk_mode, stream=True)
+        chunks = []
 
     try:
         while iteration < max_iterations:
             iteration += 1
+            utils.set_iteration(iteration)
             
             # MAP STAGE #
-            chunked_msgs = []
-            for chunk in chunks:
-                if iteration == 1:
-                    prompt = prompt_module.create_first_iteration_prompt(task, chunk, question)
-                else:
-                    if task == "rag":
-                        prompt = prompt_module.create_iteration_prompt(
-                            task, iteration, question, chunk, selected_info=filtered_info
-                        )
+            def map_msgs(source):
+                for chunk in source:
+                    if iteration == 1:
+                        prompt = prompt_module.create_first_iteration_prompt(task, chunk, question, layout=prompt_layout)
                     else:
-                        prompt = prompt_module.create_iteration_prompt(
-                            task, iteration, question, chunk, selected_info=current_info
-                        )
-                
-                msgs = prompt_module.create_chunked_msgs(prompt)
-                chunked_msgs.append((msgs, prompt))
+                        if task == "rag":
+                            prompt = prompt_module.create_iteration_prompt(
+                                task, iteration, question, chunk, selected_info=filtered_info, layout=prompt_layout
+                            )
+                        else:
+                            prompt = prompt_module.create_iteration_prompt(
+                                task, iteration, question, chunk, selected_info=current_info, layout=prompt_layout
+                            )
+                    prompt = prompt_module.add_map_output_instruction(prompt, task, map_output)
+                    yield prompt_module.create_chunked_msgs(prompt)
 
-            for chunk_id, (msgs, prompt) in enumerate(chunked_msgs):
-                map_start_time = time.time()
-                info = utils.chat(msgs)
-                map_end_time = time.time()
-                example_map_time += (map_end_time - map_start_time)
-                
-                if task in ["en", "zh"]:
-                    reduce_start_time = time.time()
-                    score = utils.get_info_score(info, question, task, prompt_module)
-                    reduce_end_time = time.time()
-                    example_reduce_time += (reduce_end_time - reduce_start_time)
-                    current_info.append((info, score))
-                elif task == "rag":
-                    current_info.append(info)
+            if chunk_stream is not None:
+                # Keep the streamed chunks for the later iterations
+                source, chunk_stream = _collect(chunk_stream, chunks), None
+            else:
+                source = chunks
+
+            # Send each chunk prompt of this iteration as soon as it is built, results stay in chunk order
+            map_start_time = time.time()
+            # Route each chunk to the same replica in every iteration so its prefix cache is reused
+            map_limits = utils.map_output_limits(task, prompt_module, map_output)
+            responses = utils.chat_many(
+                map_msgs(source),
+                concurrency=chunk_concurrency,
+                stage="map",
+                affinity_keys=((id, chunk_id) for chunk_id in itertools.count()),
+                limits=itertools.repeat(map_limits) if map_limits else None,
+            )
+            map_end_time = time.time()
+            example_map_time += (map_end_time - map_start_time)
+
+            if map_output == "text":
+                infos = responses
+                flags = ["no information" not in info.lower() for info in infos]
+                fused_scores = None
+            else:
+                # Fused map calls answer with the information, its flag and its score
+                parsed = [utils.parse_map_output(response) for response in responses]
+                infos = [information for information, _, _ in parsed]
+                flags = [has_information for _, has_information, _ in parsed]
+                fused_scores = [score for _, _, score in parsed]
+
+            if task in ["en", "zh"]:
+                reduce_start_time = time.time()
+                scores = utils.get_info_scores(
+                    infos, question, task, prompt_module, concurrency=chunk_concurrency,
+                    batch_tokens=score_batch_tokens, tokenizer=tokenizer, scores=fused_scores,
+                )
+                reduce_end_time = time.time()
+                example_reduce_time += (reduce_end_time - reduce_start_time)
+                current_info.extend(zip(infos, scores))
+            elif task == "rag":
+                current_info.extend(infos)
+                info_flags.extend(flags)
             
             # Special handling for filtered_info in RAG task
             if task == "rag":
                 filtered_info = []
-                for info in current_info:
-                    if "no information" not in info.lower():
+                for info, has_information in zip(current_info, info_flags):
+                    if has_information:
                         filtered_info.append(info)
                 
                 # Exit iteration if no information was extracted in map stage
@@ -125,7 +350,7 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
 
                         msgs = prompt_module.create_chunked_msgs(prompt)
                         reduce_start_time = time.time()
-                        final_pred = utils.chat(msgs)
+                        final_pred = utils.chat(msgs, stage="reduce")
                         reduce_end_time = time.time()
                         example_reduce_time += (reduce_end_time - reduce_start_time)
                         if "no answer" not in final_pred.lower() and "no info" not in final_pred.lower():
@@ -141,7 +366,7 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
                     )
                     msgs = prompt_module.create_chunked_msgs(prompt)
                     reduce_start_time = time.time()
-                    final_pred = utils.chat(msgs)
+                    final_pred = utils.chat(msgs, stage="reduce")
                     reduce_end_time = time.time()
                     example_reduce_time += (reduce_end_time - reduce_start_time)
                     if "no answer" not in final_pred.lower() and "no info" not in final_pred.lower():
@@ -152,7 +377,7 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
                     prompt = prompt_module.create_reduce_prompt(task, selected_info, question)
                     
                     msgs = prompt_module.create_chunked_msgs(prompt)
-                    final_pred = utils.chat(msgs)
+                    final_pred = utils.chat(msgs, stage="reduce")
                     if "no answer" not in final_pred.lower() and "no info" not in final_pred.lower():
                         break
                         
@@ -164,8 +389,8 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
                     while 2**(k-1) <= len(current_info):
                         iteration_current_info = current_info[:2**(k-1)].copy()
                         iteration_filtered_info = []
-                        for info in iteration_current_info:
-                            if "no information" not in info.lower():
+                        for info, has_information in zip(iteration_current_info, info_flags):
+                            if has_information:
                                 iteration_filtered_info.append(info)
                         if not iteration_filtered_info:
                             k += 1
@@ -176,7 +401,7 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
                         
                         msgs = prompt_module.create_chunked_msgs(prompt)
                         reduce_start_time = time.time()
-                        final_pred = utils.chat(msgs)
+                        final_pred = utils.chat(msgs, stage="reduce")
                         reduce_end_time = time.time()
                         example_reduce_time += (reduce_end_time - reduce_start_time)
                         if "no answer" not in final_pred.lower():
@@ -192,7 +417,7 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
                     
                     msgs = prompt_module.create_chunked_msgs(prompt)
                     reduce_start_time = time.time()
-                    final_pred = utils.chat(msgs)
+                    final_pred = utils.chat(msgs, stage="reduce")
                     reduce_end_time = time.time()
                     example_reduce_time += (reduce_end_time - reduce_start_time)
                     if "no answer" not in final_pred.lower():
@@ -203,13 +428,14 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
                     
                     msgs = prompt_module.create_chunked_msgs(prompt)
                     reduce_start_time = time.time()
-                    final_pred = utils.chat(msgs)
+                    final_pred = utils.chat(msgs, stage="reduce")
                     reduce_end_time = time.time()
                     example_reduce_time += (reduce_end_time - reduce_start_time)
                     if "no answer" not in final_pred.lower():
                         break
 
         # Post-process prediction for open source models
+        utils.set_iteration(None)
         is_open_source_model = "llama" in utils.model.lower()
         if task == "rag" and is_open_source_model and final_pred != "NO ANSWER":
             original_pred = final_pred
@@ -244,7 +470,24 @@ def process_example(i, examples, tokenizer, task, chunk_length, input_length, ma
         return None
 
 
-def run_pipeline(examples, tokenizer, task, chunk_length, input_length, output_dir, max_workers=1):
+def run_pipeline(
+    examples,
+    tokenizer,
+    task,
+    chunk_length,
+    input_length,
+    output_dir,
+    max_workers=1,
+    chunk_concurrency=None,
+    execution="online",
+    batch_poll_interval=30.0,
+    prompt_layout="default",
+    price_table=None,
+    tokenize_workers=0,
+    chunk_mode="token",
+    score_batch_tokens=0,
+    map_output="text",
+):
     """
     Execute the complete Map-Reduce pipeline to process multiple examples
     
@@ -256,6 +499,21 @@ def run_pipeline(examples, tokenizer, task, chunk_length, input_length, output_d
         input_length: Maximum input length to consider
         output_dir: Directory for output results
         max_workers: Number of parallel worker threads
+        chunk_concurrency: Maximum number of chunk requests in flight per example
+        execution: "online" to send every call directly, "batch" to run the first-iteration
+            map and score calls of all examples through the Batch API first
+        batch_poll_interval: Seconds between batch status checks
+        prompt_layout: Layout of the map prompts, "prefix" keeps each chunk's prompt prefix
+            identical across iterations for server-side prefix caching
+        price_table: Optional JSON file of model prices (USD per million tokens) for the usage report
+        tokenize_workers: Number of processes chunking examples ahead of the worker threads,
+            0 to chunk each example in its worker thread
+        chunk_mode: "token" cuts the context every chunk_length tokens, "boundary" packs whole
+            documents, paragraphs or sentences into chunks of at most chunk_length tokens
+        score_batch_tokens: For En.QA/Zh.QA, score the extracted information of an iteration in
+            calls of up to this many tokens of information each, 0 for one score call per chunk
+        map_output: Output format of the map calls, one of prompt_module.MAP_OUTPUTS; except for
+            "text", each map call also scores its information and flags whether it found any
         
     Returns:
         List of processing results and runtime information
@@ -266,6 +524,22 @@ def run_pipeline(examples, tokenizer, task, chunk_length, input_length, output_d
     output_dir.mkdir(parents=True, exist_ok=True)
     final_output_path = output_dir / f"final_preds.jsonl"
 
+    # Record the generation limits the predictions were made with
+    run_meta = {
+        "task": task,
+        "model": utils.model,
+        "chunk_length": chunk_length,
+        "chunk_mode": chunk_mode,
+        "input_length": input_length,
+        "score_batch_tokens": score_batch_tokens,
+        "map_output": map_output,
+        "execution": execution,
+        "prompt_layout": prompt_layout,
+        "generation_limits": utils.get_generation_limits(),
+    }
+    with open(output_dir / "run_meta.json", "w", encoding="utf8") as fout:
+        json.dump(run_meta, fout, indent=2, ensure_ascii=False)
+
     final_preds = []
     processed_ids = set()  # Set to store already processed IDs
 
@@ -317,15 +591,48 @@ def run_pipeline(examples, tokenizer, task, chunk_length, input_length, output_d
         else:
             print(f"No result for example {id}")
 
+    # Only process unprocessed IDs
+    pending_ids = [i for i in range(start_idx, stop_idx) if i not in processed_ids]
+
+    if execution == "batch":
+        prefill_with_batch(
+            examples, pending_ids, tokenizer, task, chunk_length, input_length, output_dir,
+            poll_interval=batch_poll_interval,
+            prompt_layout=prompt_layout,
+            tokenize_workers=tokenize_workers,
+            chunk_mode=chunk_mode,
+            score_batch_tokens=score_batch_tokens,
+            map_output=map_output,
+        )
+
     print(f"Processing {stop_idx - start_idx - len(processed_ids)} examples with {max_workers} workers...")
-    
+
+    if tokenize_workers:
+        example_chunks = iter_example_chunks(
+            examples, pending_ids, tokenizer, task, chunk_length, input_length,
+            tokenize_workers, prefetch=max_workers + tokenize_workers, chunk_mode=chunk_mode,
+        )
+    else:
+        example_chunks = ((i, None) for i in pending_ids)
+
+    def handle(future):
+        try:
+            result = future.result()
+            process_result(result)
+        except Exception as e:
+            print(f"Exception occurred: {e}")
+
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        # Only process unprocessed IDs
-        for i in range(start_idx, stop_idx):
-            # Skip already processed IDs
-            if i in processed_ids:
-                continue
+        futures = set()
+        for i, chunks in example_chunks:
+            # Keep the chunk lists held by queued examples bounded, and write finished
+            # predictions while submitting so a crashed run can resume from them
+            done = {future for future in futures if future.done()}
+            while len(futures) - len(done) >= 2 * max_workers:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                handle(future)
+            futures -= done
             future = executor.submit(
                 process_example,
                 i,
@@ -334,15 +641,17 @@ def run_pipeline(examples, tokenizer, task, chunk_length, input_length, output_d
                 task,
                 chunk_length,
                 input_length,
+                chunk_concurrency=chunk_concurrency,
+                prompt_layout=prompt_layout,
+                chunks=chunks,
+                chunk_mode=chunk_mode,
+                score_batch_tokens=score_batch_tokens,
+                map_output=map_output,
             )
-            futures.append(future)
+            futures.add(future)
 
         for future in as_completed(futures):
-            try:
-                result = future.result()
-                process_result(result)
-            except Exception as e:
-                print(f"Exception occurred: {e}")
+            handle(future)
 
     # Sort results by ID after processing
     final_preds.sort(key=lambda x: x["id"])
@@ -354,10 +663,46 @@ def run_pipeline(examples, tokenizer, task, chunk_length, input_length, output_d
     run_time_info = {
         "total_time": total_time,
         "map_time": map_time,
-        "reduce_time": reduce_time
+        "reduce_time": reduce_time,
+        "generation_limits": run_meta["generation_limits"],
     }
     
     print(f"Total processing time: {total_time:.2f}s, Map time: {map_time:.2f}s, Reduce time: {reduce_time:.2f}s")
+    client_stats = utils.get_client_stats()
+    run_time_info["client"] = client_stats
+    print(
+        f"LLM calls: {client_stats['retries']} retries, {client_stats['failed_calls']} failed, "
+        f"{client_stats['singleflight_saved']} saved by de-duplication"
+    )
+    if "hedges" in client_stats:
+        print(f"Hedged map calls: {client_stats['hedges']}, {client_stats['hedge_wins']} won by the hedge")
+    if "ttft" in client_stats:
+        ttft = ", ".join(f"{stage} {value:.2f}s" for stage, value in client_stats["ttft"].items())
+        print(f"Time to first token: {ttft}; {client_stats['stream_early_stopped']} map streams stopped at NO INFORMATION")
+    if client_stats["usage"]:
+        cached = ", ".join(
+            f"{stage} {usage['cached_tokens'] / max(usage['prompt_tokens'], 1):.0%} of {usage['prompt_tokens']}"
+            for stage, usage in client_stats["usage"].items()
+        )
+        print(f"Cached prompt tokens: {cached}")
+    # With tokenize_workers the cache is used in the worker processes
+    if utils.token_cache is not None and not tokenize_workers:
+        run_time_info["token_cache"] = utils.token_cache.stats()
+    if "cache" in client_stats:
+        print(f"Response cache: {client_stats['cache']['hits']} hits, {client_stats['cache']['misses']} misses")
+
+    # Token usage and estimated cost, summarized in run_time_info and in full in the report
+    usage_report = utils.get_usage_report(usage_module.load_prices(price_table))
+    with open(output_dir / "usage_report.json", "w", encoding="utf8") as fout:
+        json.dump(usage_report, fout, indent=2, ensure_ascii=False)
+    run_time_info["usage"] = {key: value for key, value in usage_report.items() if key != "by_example"}
+    totals = usage_report["totals"]
+    cost = f", estimated cost ${totals['cost']:.4f}" if "cost" in totals else ""
+    estimated = f", usage of {totals['estimated_calls']} calls estimated" if "estimated_calls" in totals else ""
+    print(
+        f"Tokens: {totals['prompt_tokens']} prompt ({totals['cached_tokens']} cached), "
+        f"{totals['completion_tokens']} completion{cost}{estimated}"
+    )
     print(f"Results saved to {output_dir}")
     
     return final_preds, run_time_info
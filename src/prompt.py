@@ -1,8 +1,47 @@
+# Layouts of the map prompts. "prefix" puts the parts that are identical in
+# every iteration (chunk and question) first and the per-iteration parts
+# last, so servers with prefix caching reuse the chunk across iterations.
+PROMPT_LAYOUTS = ("default", "prefix")
+
+# Output formats of the map calls. Except for "text", a map call answers with a
+# JSON object holding the extracted information, a has-information flag and,
+# for En.QA/Zh.QA, a relevance score, so no separate score call is needed.
+# "json" only asks for it in the prompt, "json_object" and "json_schema" also
+# set the request's response_format for backends that support it.
+MAP_OUTPUTS = ("text", "json", "json_object", "json_schema")
+
+
 def create_system_msg():
     return "You are a helpful assistant."
 
 
-def create_first_iteration_prompt(task, chunk, question):
+def create_chunk_prefix(task, chunk, question):
+    """
+    Create the leading part shared by all map prompts of a chunk in the prefix layout
+    
+    Args:
+        task: Task type ("en", "zh", or "rag")
+        chunk: The current text chunk
+        question: The question to answer
+        
+    Returns:
+        A prompt prefix string that does not depend on the iteration
+    """
+    if task == "zh":
+        prefix = (
+            "我们正在进行长文本问答任务，你负责处理其中一个文本块。\n\n"
+            "你的文本块：\n{context}\n\n问题：{question}\n\n"
+        ).format(context=chunk, question=question)
+    else:
+        prefix = (
+            "We are working on long-text question answering, and you are responsible for one chunk.\n\n"
+            "Your chunk:\n{context}\n\nQuestion: {question}\n\n"
+        ).format(context=chunk, question=question)
+    
+    return prefix
+
+
+def create_first_iteration_prompt(task, chunk, question, layout="default"):
     """
     Create prompt for the first iteration
     
@@ -10,10 +49,24 @@ def create_first_iteration_prompt(task, chunk, question):
         task: Task type ("en", "zh", or "rag")
         chunk: The current text chunk
         question: The question to answer
+        layout: Prompt layout, one of PROMPT_LAYOUTS
         
     Returns:
         A prompt string for the first iteration
     """
+    if layout == "prefix":
+        prefix = create_chunk_prefix(task, chunk, question)
+        if task == "rag":
+            return prefix + (
+                "Read the chunk above and extract as much information as possible related to the question. "
+                "Ensure your extracted information provides clear context and is logically complete. "
+                "If no information, just output \"NO INFORMATION\"."
+            )
+        elif task == "en":
+            return prefix + "Read the chunk above and extract as much information as possible related to the question."
+        elif task == "zh":
+            return prefix + "请阅读以上文本块并尽可能提取与问题相关的信息。"
+
     if task == "rag":
         prompt = (
             "We are working on long-text question answering, and you are responsible for one chunk. "
@@ -85,7 +138,81 @@ def get_info_score_prompt(info, question, task):
     return prompt
 
 
-def create_iteration_prompt(task, iteration, question, chunk, selected_info=None):
+def get_batch_score_prompt(infos, question, task):
+    """
+    Create a prompt for scoring the relevance of several extracted information strings at once
+
+    Args:
+        infos: List of extracted information to score, numbered from 1 in the prompt
+        question: The question being answered
+        task: Task type ("en", "zh", or "rag")
+
+    Returns:
+        A prompt string asking for one "N. Score: (0-100)" line per item, or None for RAG tasks
+    """
+    items = "\n\n".join(f"[{number}] {info}" for number, info in enumerate(infos, start=1))
+    lines = "\n".join(f"{number}. Score: (0-100)" for number in range(1, min(len(infos), 2) + 1))
+    if len(infos) > 2:
+        lines += "\n..."
+    if task == "en":
+        prompt = (
+            "Below are {count} pieces of information extracted from different chunks of a long text. For each of them, provide a score (0-100) for how useful the extracted information is for answering this question.\n\n"
+            "{items}\n\nQuestion: {question}\n\nPlease answer with one line per piece of information, in this format:\n\n{lines}"
+        ).format(count=len(infos), items=items, question=question, lines=lines)
+    elif task == "zh":
+        prompt = (
+            "以下是从长文本的不同文本块中提取的{count}条信息。请为每条信息给出一个分数（0-100），评估提取的信息对回答该问题的有用程度。\n\n"
+            "{items}\n\n问题：{question}\n\n请每条信息输出一行，遵循以下格式：\n\n{lines}"
+        ).format(count=len(infos), items=items, question=question, lines=lines)
+    else:  # RAG task doesn't need scoring
+        return None
+
+    return prompt
+
+
+def add_map_output_instruction(prompt, task, map_output="text"):
+    """
+    Append the JSON output instruction of fused map calls to a map prompt
+
+    Args:
+        prompt: First-iteration or iteration map prompt
+        task: Task type ("en", "zh", or "rag")
+        map_output: One of MAP_OUTPUTS, "text" leaves the prompt unchanged
+
+    Returns:
+        The prompt to send
+    """
+    if map_output == "text":
+        return prompt
+    if task == "zh":
+        return prompt.rstrip("\n") + (
+            "\n\n请输出一个JSON对象，包含键\"information\"（提取的信息）、"
+            "\"has_information\"（文本块中没有与问题相关的信息时为false）和"
+            "\"score\"（0-100，提取的信息对回答该问题的有用程度）。"
+        )
+    keys = [
+        "\"information\" (the extracted information)",
+        "\"has_information\" (false if the chunk has no information related to the question, instead of outputting \"NO INFORMATION\")",
+    ]
+    if task == "en":
+        keys.append("\"score\" (0-100, how useful the extracted information is for answering the question)")
+    return prompt.rstrip("\n") + "\n\nAnswer with a JSON object with the keys {} and {}.".format(", ".join(keys[:-1]), keys[-1])
+
+
+def map_output_schema(task):
+    """JSON schema of the answers of fused map calls"""
+    properties = {"information": {"type": "string"}, "has_information": {"type": "boolean"}}
+    if task in ["en", "zh"]:
+        properties["score"] = {"type": "integer"}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def create_iteration_prompt(task, iteration, question, chunk, selected_info=None, layout="default"):
     """
     Create prompt for subsequent iterations
     
@@ -95,10 +222,28 @@ def create_iteration_prompt(task, iteration, question, chunk, selected_info=None
         question: The question to answer
         chunk: The current text chunk
         selected_info: Previously extracted information
+        layout: Prompt layout, one of PROMPT_LAYOUTS
         
     Returns:
         A prompt string for the current iteration
     """
+    if layout == "prefix":
+        prefix = create_chunk_prefix(task, chunk, question)
+        # The extracted information only grows between iterations, so it goes before the iteration number
+        if task == "zh":
+            return prefix + (
+                "先前提取的信息：\n{selected_info}\n\n"
+                "这是第{iteration}轮问答。我们在之前几轮已经对所有文本块中提取了以上信息。请基于先前提取的信息和问题，从当前文本块中提取新信息。不要重复已提取的信息。"
+            ).format(iteration=iteration, selected_info=selected_info)
+        prompt = prefix + (
+            "Previously extracted information:\n{selected_info}\n\n"
+            "This is the {iteration} round of Q&A. And we have the previously extracted information above from all chunks in the previous round. "
+            "Based on the previously extracted information and question, extract new information from the chunk. Do not repeat the previously extracted information."
+        ).format(iteration=iteration, selected_info=selected_info)
+        if task == "rag":
+            prompt += " If no new information, just output \"NO INFORMATION\"."
+        return prompt
+
     if task == "en":
         prompt = (
             "We are working on long-text question answering, and you are responsible for one chunk. This is the {iteration} round of Q&A. And we have the previously extracted information from all chunks in the previous round. Based on the previously extracted information and question, extract new information from the chunk. Do not repeat the previously extracted information.\n\n"
@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from .scheduler import STAGE_PRIORITY
+
+# Per-message formatting overhead of the chat format, in tokens
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+class RateLimiter:
+    """
+    Client-side token buckets for requests-per-minute and tokens-per-minute limits
+
+    Each request is charged one request plus its estimated prompt tokens and
+    the maximum number of output tokens it may generate. Requests wait until
+    both buckets can cover them, so the provider limits are never exceeded.
+    Waiting requests are admitted in the order of PriorityScheduler (stage
+    priority, then example start, then arrival), so a throttled run still
+    finishes examples before starting more map work. Must only be used from
+    the client event loop.
+    """
+
+    def __init__(self, rpm=None, tpm=None, tokenizer=None, default_max_tokens=512):
+        self.rpm = rpm or None
+        self.tpm = tpm or None
+        self.tokenizer = tokenizer
+        self.default_max_tokens = default_max_tokens
+        self.requests = float(self.rpm or 0)
+        self.tokens = float(self.tpm or 0)
+        self.updated = time.monotonic()
+        self.throttled_time = 0.0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._arrived = asyncio.Event()
+        self._dispatcher = None
+
+    def estimate_tokens(self, messages, max_tokens=None):
+        """
+        Estimate the TPM cost of a request
+
+        Args:
+            messages: Chat messages of the request
+            max_tokens: Output token limit of the request, if any
+
+        Returns:
+            Estimated prompt tokens plus maximum output tokens
+        """
+        prompt_tokens = TOKENS_PER_REPLY
+        for message in messages:
+            content = message.get("content") or ""
+            if self.tokenizer:
+                prompt_tokens += len(self.tokenizer.encode(content, disallowed_special=()))
+            else:
+                prompt_tokens += len(content) // 4 + 1
+            prompt_tokens += TOKENS_PER_MESSAGE
+        return prompt_tokens + (max_tokens or self.default_max_tokens)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60.0)
+
+    def _wait_time(self, tokens):
+        wait = 0.0
+        if self.rpm and self.requests < 1:
+            wait = max(wait, (1 - self.requests) * 60.0 / self.rpm)
+        if self.tpm and self.tokens < tokens:
+            wait = max(wait, (tokens - self.tokens) * 60.0 / self.tpm)
+        return wait
+
+    async def acquire(self, tokens, stage="map", example_start=0.0):
+        """
+        Wait until one request with the given token cost can be sent
+
+        Args:
+            tokens: Estimated token cost from estimate_tokens
+            stage: Pipeline stage of the request, earlier stages wait behind later ones
+            example_start: Start time of the owning example, requests of older examples go first
+        """
+        if not self.rpm and not self.tpm:
+            return
+        if self.tpm:
+            # A single request larger than the bucket could never be admitted
+            tokens = min(tokens, self.tpm)
+        self._refill()
+        if not self._waiters and self._wait_time(tokens) <= 0:
+            self._charge(tokens)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        priority = STAGE_PRIORITY.get(stage, STAGE_PRIORITY["map"])
+        heapq.heappush(self._waiters, (priority, example_start, next(self._counter), tokens, future))
+        self._arrived.set()
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The budget was granted just before cancellation, hand it back
+                self._charge(tokens, count=-1)
+            else:
+                # The dispatcher may be sleeping for this request, let it look at the next one
+                self._arrived.set()
+            raise
+
+    def _charge(self, tokens, count=1):
+        """Take count requests of the given token cost from the buckets, a negative count refunds them"""
+        if self.rpm:
+            self.requests -= count
+        if self.tpm:
+            self.tokens -= count * tokens
+
+    async def _dispatch(self):
+        """Admit waiting requests in priority order as the buckets refill"""
+        try:
+            while self._waiters:
+                *_, tokens, future = self._waiters[0]
+                if future.cancelled():
+                    heapq.heappop(self._waiters)
+                    continue
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    heapq.heappop(self._waiters)
+                    self._charge(tokens)
+                    future.set_result(None)
+                    continue
+                # Sleep until the head can be admitted, or until a new or cancelled request changes the head
+                self._arrived.clear()
+                started = time.monotonic()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                self.throttled_time += time.monotonic() - started
+        finally:
+            self._dispatcher = None
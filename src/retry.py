@@ -0,0 +1,90 @@
+import random
+import openai
+
+
+class IncompleteResponseError(Exception):
+    """The API returned a completion without message content"""
+
+
+def is_retryable(exc):
+    """
+    Classify an error raised by an LLM call
+
+    Rate limits (429), server errors (5xx), timeouts, connection errors and
+    empty completions are transient. Everything else, e.g. a prompt over the
+    context window (400) or a bad API key (401/403), will fail again.
+    """
+    if isinstance(exc, (IncompleteResponseError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return False
+
+
+def get_retry_after(exc):
+    """Return the Retry-After delay in seconds sent with an error response, if any"""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Retry decisions for LLM calls
+
+    Transient errors are retried with full-jitter exponential backoff, at most
+    `max_retries` times per call. Retries also draw from a run-wide budget that
+    starts at `budget_reserve` and earns `budget_ratio` of a retry per call, so
+    during an outage calls fail quickly instead of retrying in lockstep.
+    Must only be used from the client event loop.
+    """
+
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0, budget_ratio=0.2, budget_reserve=50):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_reserve = budget_reserve
+        self.balance = float(budget_reserve)
+        self.retries = 0
+        self.failures = 0
+
+    def on_call(self):
+        """Record a new call, earning retry budget"""
+        self.balance = min(float(self.budget_reserve), self.balance + self.budget_ratio)
+
+    def should_retry(self, exc, attempt):
+        """
+        Decide whether a failed attempt should be retried
+
+        Args:
+            exc: The exception raised by the attempt
+            attempt: Number of failed attempts so far for this call
+
+        Returns:
+            True if the call should be retried
+        """
+        if not is_retryable(exc):
+            print(f"Fatal error, not retrying: {exc}")
+        elif attempt > self.max_retries:
+            print(f"Giving up after {attempt} attempts: {exc}")
+        elif self.balance < 1:
+            print(f"Retry budget exhausted, not retrying: {exc}")
+        else:
+            self.balance -= 1
+            self.retries += 1
+            return True
+        self.failures += 1
+        return False
+
+    def backoff(self, attempt, exc=None):
+        """Delay in seconds before the given retry attempt"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
@@ -0,0 +1,91 @@
+import asyncio
+import heapq
+import itertools
+
+# Lower value is served first. Finishing an example (reduce/postprocess) beats
+# scoring, which beats starting more map work.
+STAGE_PRIORITY = {
+    "reduce": 0,
+    "postprocess": 0,
+    "score": 1,
+    "map": 2,
+}
+
+
+class PriorityScheduler:
+    """
+    Admission queue for LLM requests with a fixed number of in-flight slots
+
+    Waiting requests are ordered by stage priority, then by the start time of
+    the example they belong to (FIFO), then by arrival order. Must only be used
+    from the client event loop.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    def waiting(self):
+        """Number of requests queued for a slot"""
+        return sum(1 for *_, future in self._waiters if not future.cancelled())
+
+    async def acquire(self, stage="map", example_start=0.0):
+        """Wait for an in-flight slot"""
+        self._prune()
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        priority = STAGE_PRIORITY.get(stage, STAGE_PRIORITY["map"])
+        heapq.heappush(self._waiters, (priority, example_start, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just before cancellation, hand it back
+                self.release()
+            raise
+
+    def set_limit(self, limit):
+        """Change the number of in-flight slots, admitting waiters if it grew"""
+        self.limit = limit
+        self._wake()
+
+    def release(self):
+        """Free a slot and admit the next waiting request"""
+        self.in_flight -= 1
+        self._wake()
+
+    def _prune(self):
+        while self._waiters and self._waiters[0][-1].cancelled():
+            heapq.heappop(self._waiters)
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.limit:
+            *_, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def slot(self, stage="map", example_start=0.0):
+        """Async context manager holding one slot for the duration of a request"""
+        return _Slot(self, stage, example_start)
+
+
+class _Slot:
+    def __init__(self, scheduler, stage, example_start):
+        self.scheduler = scheduler
+        self.stage = stage
+        self.example_start = example_start
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.stage, self.example_start)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release()
+        return False
@@ -0,0 +1,53 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    De-duplicate identical requests that are in flight at the same time
+
+    The first caller for a key starts the upstream call; callers arriving with
+    the same key before it finishes wait on that call and share its result (or
+    its exception). The call is cancelled once every caller waiting on it is
+    cancelled. Must only be used from the client event loop.
+    """
+
+    def __init__(self):
+        self.saved = 0
+        self._calls = {}
+        self._waiters = {}
+
+    async def do(self, key, fn):
+        """
+        Run fn() once per key among concurrent callers
+
+        Args:
+            key: Request key, equal keys must mean interchangeable results
+            fn: Coroutine function performing the call
+
+        Returns:
+            Result of the shared call
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.saved += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # A cancelled caller must not cancel the call other callers wait on
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                # Nobody waits for the call any more, stop paying for it
+                if not task.done():
+                    task.cancel()
+
+    def _finish(self, key, task):
+        self._calls.pop(key, None)
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
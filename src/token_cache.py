@@ -0,0 +1,175 @@
+"""
+Persistent cache of encoded texts
+
+Each text is stored once per encoding as a uint32 .npy file named by the
+SHA-256 of the encoding name and the text, and read back memory-mapped, so
+repeated runs skip tokenization and worker threads share the pages. Pre-warm
+the cache for a dataset with:
+
+    python -m src.token_cache --data_path ./data/rag_1000k.jsonl --cache_dir ./token_cache
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+def encoding_name(tokenizer):
+    """Name identifying a tokenizer's vocabulary, part of the cache key"""
+    return getattr(tokenizer, "name", None) or getattr(tokenizer, "name_or_path", None) or type(tokenizer).__name__
+
+
+class TokenCache:
+    """
+    Directory of encoded texts as memory-mapped uint32 arrays
+
+    Arrays returned by `encode` are read-only views of the cache files.
+    Files are written to a temporary name and renamed into place, so
+    concurrent writers and readers never see partial arrays.
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = Path(path)
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not read_only:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+    def key(self, tokenizer, text):
+        digest = hashlib.sha256(encoding_name(tokenizer).encode("utf8") + b"\0")
+        digest.update(text.encode("utf8", errors="surrogatepass"))
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return self.path / key[:2] / f"{key}.npy"
+
+    def get(self, tokenizer, text):
+        """Cached tokens of text as a read-only uint32 array, or None"""
+        path = self._file(self.key(tokenizer, text))
+        if not path.exists():
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def put(self, tokenizer, text, tokens):
+        """
+        Store the tokens of text
+
+        Args:
+            tokenizer: Tokenizer the tokens come from
+            text: Encoded text
+            tokens: Sequence of token ids
+
+        Returns:
+            The tokens as a uint32 array, memory-mapped from the cache file when stored
+        """
+        tokens = np.asarray(tokens, dtype=np.uint32)
+        if self.read_only:
+            return tokens
+        path = self._file(self.key(tokenizer, text))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npy")
+        np.save(tmp, tokens)
+        os.replace(tmp, path)
+        return np.load(path, mmap_mode="r")
+
+    def encode(self, tokenizer, text):
+        """
+        Tokens of text, from the cache or encoded and stored
+
+        Args:
+            tokenizer: Tokenizer with an encode method
+            text: Text to encode
+
+        Returns:
+            uint32 array equal to tokenizer.encode(text)
+        """
+        tokens = self.get(tokenizer, text)
+        with self._lock:
+            if tokens is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if tokens is None:
+            tokens = self.put(tokenizer, text, tokenizer.encode(text))
+        return tokens
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def prewarm(cache, tokenizer, texts, batch_size=16, num_threads=8):
+    """
+    Encode and store all texts missing from the cache
+
+    Args:
+        cache: TokenCache to fill
+        tokenizer: Tokenizer to encode with, tiktoken encodings encode batches in parallel threads
+        texts: Iterable of texts
+        batch_size: Texts encoded per batch
+        num_threads: Threads used by tiktoken's encode_batch
+
+    Returns:
+        Number of texts that were encoded
+    """
+    encoded = 0
+    batch = []
+
+    def flush():
+        nonlocal encoded
+        if hasattr(tokenizer, "encode_batch"):
+            token_lists = tokenizer.encode_batch(batch, num_threads=num_threads)
+        else:
+            token_lists = [tokenizer.encode(text) for text in batch]
+        for text, tokens in zip(batch, token_lists):
+            cache.put(tokenizer, text, tokens)
+        encoded += len(batch)
+        print(f"Encoded {encoded} texts")
+        batch.clear()
+
+    for text in texts:
+        if cache.get(tokenizer, text) is not None:
+            continue
+        batch.append(text)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return encoded
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, required=True)
+    parser.add_argument("--cache_dir", type=str, default="./token_cache")
+    parser.add_argument("--model", type=str, default="gpt-4o", help="Model whose tiktoken encoding is used")
+    parser.add_argument("--field", type=str, default="context", help="Field of each example holding the text")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_threads", type=int, default=os.cpu_count() or 1)
+    return parser.parse_args()
+
+
+def main():
+    import tiktoken
+
+    args = parse_args()
+    tokenizer = tiktoken.encoding_for_model(args.model)
+    cache = TokenCache(args.cache_dir)
+
+    def texts():
+        with open(args.data_path, "r", encoding="utf8") as fin:
+            for line in fin:
+                if line.strip():
+                    yield json.loads(line)[args.field]
+
+    encoded = prewarm(cache, tokenizer, texts(), batch_size=args.batch_size, num_threads=args.num_threads)
+    print(f"Token cache {args.cache_dir}: encoded {encoded} new texts with {tokenizer.name}")
+
+
+if __name__ == "__main__":
+    main()
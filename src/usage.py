@@ -0,0 +1,175 @@
+import json
+
+# USD per million tokens. "batch" is the price multiplier of Batch API requests.
+DEFAULT_PRICES = {
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00, "batch": 0.5},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60, "batch": 0.5},
+    "gpt-4.1": {"input": 2.00, "cached_input": 0.50, "output": 8.00, "batch": 0.5},
+    "gpt-4.1-mini": {"input": 0.40, "cached_input": 0.10, "output": 1.60, "batch": 0.5},
+    "gpt-4.1-nano": {"input": 0.10, "cached_input": 0.025, "output": 0.40, "batch": 0.5},
+}
+
+TOKEN_FIELDS = ("prompt_tokens", "completion_tokens", "cached_tokens")
+
+
+def load_prices(path=None):
+    """
+    Price table for cost estimates
+
+    Args:
+        path: Optional JSON file mapping model names to {"input", "cached_input", "output", "batch"},
+            entries override and extend DEFAULT_PRICES
+
+    Returns:
+        Dict mapping model names to prices
+    """
+    prices = {name: dict(price) for name, price in DEFAULT_PRICES.items()}
+    if path:
+        with open(path, "r", encoding="utf8") as fin:
+            prices.update(json.load(fin))
+    return prices
+
+
+def get_price(prices, model):
+    """Price entry of a model, matching the longest model name prefix (e.g. dated snapshots), or None"""
+    matches = [name for name in prices if model == name or model.startswith(name + "-")]
+    return prices[max(matches, key=len)] if matches else None
+
+
+def estimate_cost(record, price):
+    """
+    Estimated cost in USD of a usage record
+
+    Args:
+        record: Dict with prompt_tokens, completion_tokens, cached_tokens and batch
+        price: Price entry from the price table, None when unknown
+
+    Returns:
+        Cost in USD, or None without a price
+    """
+    if price is None:
+        return None
+    uncached = record["prompt_tokens"] - record["cached_tokens"]
+    cost = (
+        uncached * price["input"]
+        + record["cached_tokens"] * price.get("cached_input", price["input"])
+        + record["completion_tokens"] * price["output"]
+    ) / 1e6
+    if record.get("batch"):
+        cost *= price.get("batch", 1.0)
+    return cost
+
+
+def _distribution(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p90": values[min(len(values) - 1, int(len(values) * 0.9))],
+        "max": values[-1],
+    }
+
+
+class UsageTracker:
+    """
+    Token usage of every LLM call, tagged by stage, iteration and example
+
+    Records are appended from the client event loop (and from the main
+    thread for batch results), list appends keep this thread-safe.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, stage, usage, example_id=None, iteration=None, batch=False, estimated=False):
+        """
+        Add the usage of one call
+
+        Args:
+            stage: Pipeline stage of the call
+            usage: Completion `usage` object or dict
+            example_id: Example the call belongs to
+            iteration: Map-reduce iteration of the call
+            batch: Whether the call ran through the Batch API
+            estimated: Whether the usage is a client-side estimate, e.g. of a stream closed
+                before the API reported its usage
+        """
+        if usage is None:
+            return
+        if isinstance(usage, dict):
+            details = usage.get("prompt_tokens_details") or {}
+            cached = details.get("cached_tokens")
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        else:
+            cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        self.records.append({
+            "stage": stage,
+            "example_id": example_id,
+            "iteration": iteration,
+            "batch": batch,
+            "estimated": estimated,
+            "prompt_tokens": prompt_tokens or 0,
+            "completion_tokens": completion_tokens or 0,
+            "cached_tokens": cached or 0,
+        })
+
+    def totals(self, key=None, price=None):
+        """
+        Sum the records, optionally grouped
+
+        Args:
+            key: Record field to group by ("stage", "iteration" or "example_id"), None for one total
+            price: Price entry for cost estimates
+
+        Returns:
+            Dict of token totals (and cost), or a dict of them per group; "estimated_calls"
+            counts the calls whose usage is a client-side estimate, if any
+        """
+        groups = {}
+        for record in list(self.records):
+            group = groups.setdefault(None if key is None else record[key], dict.fromkeys(TOKEN_FIELDS, 0))
+            for field in TOKEN_FIELDS:
+                group[field] += record[field]
+            group["calls"] = group.get("calls", 0) + 1
+            if record["estimated"]:
+                group["estimated_calls"] = group.get("estimated_calls", 0) + 1
+            if price is not None:
+                group["cost"] = group.get("cost", 0.0) + estimate_cost(record, price)
+        if key is None:
+            return groups.get(None, dict.fromkeys(TOKEN_FIELDS, 0))
+        return groups
+
+    def report(self, model, prices):
+        """
+        Run report of token usage and estimated cost
+
+        Args:
+            model: Model name used to look up the price
+            prices: Price table from load_prices
+
+        Returns:
+            Dict with totals, per-stage, per-iteration and per-example usage and
+            the distribution of per-example tokens and cost
+        """
+        price = get_price(prices, model)
+        by_example = self.totals("example_id", price)
+        by_example.pop(None, None)
+        per_example = {
+            "total_tokens": _distribution([
+                usage["prompt_tokens"] + usage["completion_tokens"] for usage in by_example.values()
+            ]),
+        }
+        if price is not None:
+            per_example["cost"] = _distribution([usage["cost"] for usage in by_example.values()])
+        return {
+            "model": model,
+            "price": price,
+            "totals": self.totals(price=price),
+            "by_stage": self.totals("stage", price),
+            "by_iteration": {str(key): value for key, value in self.totals("iteration", price).items()},
+            "per_example": per_example,
+            "by_example": {str(key): value for key, value in sorted(by_example.items())},
+        }
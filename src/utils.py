@@ -3,56 +3,174 @@ import re
 import os
 import time
 import threading
-import httpx
 from pathlib import Path
 from typing import Optional
-from openai import OpenAI
 
-# Global client and model variables
-client = None
+import numpy as np
+import tiktoken
+
+from . import llm
+from .token_cache import TokenCache
+
+# Global model variable
 model = None
 
-def initialize_client(api_url, api_key, model_name):
-    """Initialize client and set global variables"""
-    global client, model
-    client = OpenAI(
-        base_url=api_url, 
-        api_key=api_key,
-        http_client=httpx.Client(
-            base_url=api_url,
-            follow_redirects=True,
-        ),
+# Persistent cache of encoded contexts, see initialize_token_cache
+token_cache = None
+
+# Generation limit overrides that lift a stage's token budget and stop sequences
+UNBOUNDED = {"max_tokens": None, "stop": None}
+
+# Positions where tiktoken's pre-tokenization regex always starts a new piece:
+# a space after a non-space, or a letter/digit after a newline. Text split at
+# such a position encodes to the concatenation of the encodings of both sides.
+SAFE_SPLIT = re.compile(r"(?<=\S) |(?<=\n)(?=[^\W_])")
+# Initial characters-per-token guess when encoding only part of a text
+CHARS_PER_TOKEN = 4
+
+# Fields of a fused map answer whose JSON does not parse, e.g. cut off by the token budget
+MAP_OUTPUT_FIELDS = {
+    "information": re.compile(r'"information"\s*:\s*"((?:[^"\\]|\\.)*)'),
+    "has_information": re.compile(r'"has_information"\s*:\s*"?(true|false)', re.IGNORECASE),
+    "score": re.compile(r'"score"\s*:\s*"?(\d+(?:\.\d+)?)'),
+}
+
+# A line of a batched scoring response: "3. Score: 85", "[3] 85", "3: 85". The item
+# number and score must be on one line with a separator, so bare numbers never match
+BATCH_SCORE_LINE = re.compile(
+    r"^[^\w\n]*(\d+)[^\w\n]+(?:(?:score|分数)[^\w\n]*)?(\d+(?:\.\d+)?)", re.IGNORECASE | re.MULTILINE
+)
+
+# How create_chunks cuts the context: every chunk_length tokens, or at unit boundaries
+CHUNK_MODES = ("token", "boundary")
+
+# Boundaries between the units packed into chunks, strongest first: blank lines
+# (documents, paragraphs), line breaks and sentence ends. A chunk ends after the
+# separator, so the next one starts with the unit's text.
+UNIT_BOUNDARIES = (
+    re.compile(rb"\n[ \t\r]*\n\s*"),
+    re.compile(rb"\n\s*"),
+    re.compile(rb"(?<=[.!?])\s+|(?:" + "|".join("。！？").encode("utf8") + rb")\s*"),
+)
+
+# Byte length of every token id per tiktoken encoding, see token_byte_lengths
+_token_byte_lengths = {}
+_token_byte_lengths_lock = threading.Lock()
+
+def initialize_client(
+    api_url,
+    api_key,
+    model_name,
+    max_inflight=64,
+    rpm=None,
+    tpm=None,
+    tokenizer=None,
+    adaptive_concurrency=False,
+    min_inflight=1,
+    timeout=120.0,
+    max_retries=5,
+    retry_budget=0.2,
+    stream=False,
+    hedge_percentile=None,
+    hedge_max_rate=0.05,
+):
+    """Initialize the async client and set global variables"""
+    global model
+    llm.initialize(
+        api_url,
+        api_key,
+        model_name,
+        max_inflight_requests=max_inflight,
+        rpm=rpm,
+        tpm=tpm,
+        tokenizer=tokenizer,
+        adaptive_concurrency=adaptive_concurrency,
+        min_inflight_requests=min_inflight,
+        timeout=timeout,
+        max_retries=max_retries,
+        retry_budget=retry_budget,
+        stream_responses=stream,
+        hedge_percentile=hedge_percentile,
+        hedge_max_rate=hedge_max_rate,
     )
     model = model_name
 
 
-def chat(messages: list):
+def initialize_cache(path, max_size_mb=1024, read_only=False):
+    """Enable the persistent LLM response cache"""
+    llm.initialize_cache(path, max_size_mb=max_size_mb, read_only=read_only)
+
+
+def get_client_stats():
+    """Counters of the LLM client (retries, de-duplicated calls, cache hits, ...)"""
+    return llm.get_stats()
+
+
+def set_generation_limits(stage, max_tokens=None, stop=None):
+    """Set the output token budget and stop sequences of a pipeline stage"""
+    llm.set_generation_limits(stage, max_tokens=max_tokens, stop=stop)
+
+
+def get_generation_limits():
+    """Output token budgets and stop sequences of all pipeline stages"""
+    return {stage: dict(limits) for stage, limits in llm.generation_limits.items()}
+
+
+def chat(messages: list, stage="map", limits=None):
     """Chat function using global client and model"""
-    is_open_source_model = "llama" in model.lower()
-    temperature = 0.1 if is_open_source_model else 0.0
+    return llm.chat(messages, stage=stage, limits=limits)
+
+
+def chat_many(messages_list, concurrency=None, stage="map", affinity_keys=None, limits=None):
+    """Send several chat requests in parallel, returning responses in order"""
+    return llm.chat_many(
+        messages_list, concurrency=concurrency, stage=stage, affinity_keys=affinity_keys, limits=limits
+    )
+
+
+def build_request(messages, stage="map", limits=None):
+    """Chat completion request body for a pipeline call, as sent online or in a batch file"""
+    return llm.build_request(messages, stage=stage, limits=limits)
+
+
+def prefill_responses(requests, results):
+    """
+    Make later chat calls return results obtained elsewhere (e.g. from a batch job)
     
-    while True:
-        try:
-            completion = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
-            if (
-                hasattr(completion, 'choices') and 
-                len(completion.choices) > 0 and 
-                hasattr(completion.choices[0], 'message') and 
-                completion.choices[0].message and 
-                hasattr(completion.choices[0].message, 'content') and 
-                completion.choices[0].message.content
-            ):
-                return completion.choices[0].message.content
-            else:
-                print("Received incomplete response, retrying...")
-                time.sleep(10)
-        except Exception as e:
-            print(f"Error occurred: {e}")
-            time.sleep(10)
+    Args:
+        requests: Dict mapping an id to a request body from build_request
+        results: Dict mapping the same ids to response content
+    """
+    llm.prefill({
+        llm.make_key(**requests[request_id]): content
+        for request_id, content in results.items()
+    })
+
+
+def initialize_token_cache(path, read_only=False):
+    """Reuse encoded contexts across runs from a directory of memory-mapped token arrays"""
+    global token_cache
+    token_cache = TokenCache(path, read_only=read_only)
+
+
+def set_example_context(example_id, start_time=None):
+    """Tag LLM calls made from the current thread with the example being processed"""
+    llm.set_example_context(example_id, start_time)
+
+
+def set_iteration(iteration):
+    """Tag LLM calls made from the current thread with the map-reduce iteration"""
+    llm.set_iteration(iteration)
+
+
+def record_usage(stage, usage, example_id=None, iteration=None, batch=False):
+    """Record token usage of a call made outside the chat functions, e.g. in a batch job"""
+    llm.usage.record(stage, usage, example_id=example_id, iteration=iteration, batch=batch)
+
+
+def get_usage_report(prices):
+    """Token usage and estimated cost of the run by stage, iteration and example"""
+    return llm.usage.report(model, prices)
 
 
 def truncate_input(input, max_length, manner="middle"):
@@ -60,16 +178,19 @@ def truncate_input(input, max_length, manner="middle"):
     Truncate input to max_length
     
     Args:
-        input: Input tokens or text to truncate
+        input: Input tokens (list or array) or text to truncate
         max_length: Maximum length to keep
         manner: Truncation method - "middle" keeps first and last half, "front" keeps first part
         
     Returns:
-        Truncated input
+        Truncated input, a view of the input for arrays cut at the front
     """
     if len(input) <= max_length:
         return input
     if manner == "middle":
+        if isinstance(input, np.ndarray):
+            # Arrays add elementwise, join them instead
+            return np.concatenate([input[0 : max_length // 2], input[-max_length // 2 :]])
         return input[0 : max_length // 2] + input[-max_length // 2 :]
     elif manner == "front":
         return input[:max_length]
@@ -82,21 +203,365 @@ def chunk_input(input, chunk_length):
     Split input into chunks of chunk_length
     
     Args:
-        input: Input tokens or text to split
+        input: Input tokens (list or array) or text to split
         chunk_length: Length of each chunk
         
     Returns:
-        List of chunks
+        List of chunks, views of the input for arrays
     """
     return [input[i : i + chunk_length] for i in range(0, len(input), chunk_length)]
 
 
+def encode_array(tokenizer, text):
+    """Tokens of text as a uint32 array, without building a list of ints for tiktoken encodings"""
+    if isinstance(tokenizer, tiktoken.Encoding):
+        try:
+            return tokenizer.encode_to_numpy(text)
+        except UnicodeEncodeError:
+            # Replace lone surrogates (e.g. from a JSON "\ud800" escape) as tokenizer.encode does
+            return tokenizer.encode_to_numpy(text.encode("utf-16", "surrogatepass").decode("utf-16", "replace"))
+    return np.asarray(tokenizer.encode(text), dtype=np.uint32)
+
+
+def _concatenate(parts):
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.uint32)
+
+
+def _split_after(text, pos):
+    """First safe split position at or after pos, or len(text)"""
+    match = SAFE_SPLIT.search(text, min(pos, len(text)))
+    return match.start() if match else len(text)
+
+
+def _split_before(text, pos):
+    """Last safe split position at or before pos, or 0"""
+    window = 256
+    while pos > 0:
+        last = None
+        for match in SAFE_SPLIT.finditer(text, max(0, pos - window), pos + 1):
+            last = match.start()
+        if last is not None:
+            return last
+        pos -= window
+        window *= 2
+    return 0
+
+
+def _encode_head(tokenizer, text, count):
+    """
+    Encode a prefix of text holding at least count tokens
+
+    Returns:
+        (tokens of text[:end], end), end is len(text) if the whole text has fewer tokens
+    """
+    parts = []
+    length = 0
+    end = 0
+    chars = count * CHARS_PER_TOKEN
+    while length < count and end < len(text):
+        new_end = _split_after(text, max(chars, end + 1))
+        parts.append(encode_array(tokenizer, text[end:new_end]))
+        length += len(parts[-1])
+        end = new_end
+        # Extrapolate from the density seen so far, with some margin
+        chars = int(end * 1.1 * count / max(length, 1)) + 64
+    return _concatenate(parts), end
+
+
+def _encode_tail(tokenizer, text, count):
+    """
+    Encode a suffix of text holding at least count tokens
+
+    Returns:
+        (tokens of text[start:], start), start is 0 if the whole text has fewer tokens
+    """
+    parts = []
+    length = 0
+    start = len(text)
+    chars = count * CHARS_PER_TOKEN
+    while length < count and start > 0:
+        new_start = _split_before(text, min(len(text) - chars, start - 1))
+        parts.append(encode_array(tokenizer, text[new_start:start]))
+        length += len(parts[-1])
+        start = new_start
+        chars = int((len(text) - start) * 1.1 * count / max(length, 1)) + 64
+    return _concatenate(parts[::-1]), start
+
+
+def _tokens_after(tokenizer, text, end, tail, start):
+    """
+    Tokens of text[end:] given the tokens of text[start:], for safe split positions start <= end
+
+    The tokens of the overlap text[start:end] are skipped by their byte lengths, so
+    nothing is encoded again unless the bytes do not line up (lone surrogates).
+    """
+    try:
+        skip = len(text[start:end].encode("utf8"))
+    except UnicodeEncodeError:
+        skip = -1
+    if skip >= 0:
+        ends = np.cumsum(token_byte_lengths(tokenizer)[tail], dtype=np.int64)
+        idx = int(np.searchsorted(ends, skip, side="right"))
+        if skip == 0 or (idx > 0 and ends[idx - 1] == skip):
+            return tail[idx:]
+    return encode_array(tokenizer, text[end:])
+
+
+def encode_truncated(tokenizer, text, max_length, manner="middle"):
+    """
+    Tokens of text truncated to max_length, encoding only the parts that are kept
+    
+    Same result as truncate_input(tokenizer.encode(text), max_length, manner), but for
+    tiktoken encodings only about max_length tokens worth of text are encoded.
+    
+    Args:
+        tokenizer: Tokenizer to use for encoding
+        text: Text to encode
+        max_length: Maximum number of tokens to keep
+        manner: Truncation method - "middle" or "front"
+        
+    Returns:
+        uint32 array of tokens
+    """
+    if not isinstance(tokenizer, tiktoken.Encoding) or max_length <= 0:
+        return truncate_input(encode_array(tokenizer, text), max_length, manner=manner)
+
+    if manner != "middle":
+        tokens, _ = _encode_head(tokenizer, text, max_length)
+        return tokens[:max_length]
+
+    head_length = max_length // 2
+    tail_length = max_length - head_length
+    head, end = _encode_head(tokenizer, text, head_length)
+    if end >= len(text):
+        # The whole text was encoded (short text, or no safe split position)
+        return truncate_input(head, max_length, manner=manner)
+    tail, start = _encode_tail(tokenizer, text, tail_length)
+    if end <= start and len(tail) >= tail_length:
+        return np.concatenate([head[:head_length], tail[len(tail) - tail_length:]])
+    # Head and tail overlap, the text is about max_length tokens anyway
+    tokens = np.concatenate([head, _tokens_after(tokenizer, text, end, tail, start)])
+    return truncate_input(tokens, max_length, manner=manner)
+
+
+def token_byte_lengths(tokenizer):
+    """Array of the UTF-8 byte length of every token id of a tiktoken encoding"""
+    with _token_byte_lengths_lock:
+        lengths = _token_byte_lengths.get(tokenizer.name)
+        if lengths is None:
+            lengths = np.zeros(tokenizer.n_vocab, dtype=np.int32)
+            for token in range(tokenizer.n_vocab):
+                try:
+                    lengths[token] = len(tokenizer.decode_single_token_bytes(token))
+                except KeyError:
+                    pass
+            _token_byte_lengths[tokenizer.name] = lengths
+        return lengths
+
+
+def _byte_region(text, nbytes, from_end=False):
+    """
+    The first (or last) nbytes bytes of the UTF-8 encoding of text
+
+    A str when that part of the text is ASCII, bytes otherwise. Every character
+    takes at least one byte, so only the first (last) nbytes characters are encoded.
+    """
+    part = text[len(text) - nbytes:] if from_end else text[:nbytes]
+    if part.isascii():
+        return part
+    data = part.encode("utf8")
+    return data[len(data) - nbytes:] if from_end else data[:nbytes]
+
+
+def slice_chunks(tokenizer, text, tokens, chunk_length, max_length, manner="middle"):
+    """
+    Cut text into the chunks that decoding every chunk_length tokens would give
+
+    Tokens of a text concatenate to its UTF-8 bytes, so each chunk is a byte
+    range of the kept head of the text or of its tail (or both, for the chunk
+    spanning the gap left by "middle" truncation). Decoding a range with
+    errors="replace" is what tokenizer.decode does, including for characters
+    split between chunks, and ASCII parts are sliced without decoding.
+
+    Args:
+        tokenizer: tiktoken encoding the tokens come from
+        text: The encoded text
+        tokens: encode_truncated(tokenizer, text, max_length, manner)
+        chunk_length: Tokens per chunk
+        max_length: Maximum input length the tokens were truncated to
+        manner: Truncation method - "middle" or "front"
+
+    Returns:
+        List of text chunks, or None if the text cannot be sliced (use decode instead)
+    """
+    if not isinstance(tokenizer, tiktoken.Encoding) or max_length <= 0 or chunk_length <= 0:
+        return None
+
+    # Truncated "middle" tokens are a head starting the text and a tail ending it
+    head = max_length // 2 if manner == "middle" and len(tokens) >= max_length else len(tokens)
+    offsets = _chunk_offsets(tokenizer, tokens, chunk_length, head)
+    head_bytes = offsets[head]
+    tail_bytes = offsets[len(tokens)] - head_bytes
+    try:
+        head_data = _byte_region(text, head_bytes)
+        tail_data = _byte_region(text, tail_bytes, from_end=True)
+    except UnicodeEncodeError:
+        # Lone surrogates are replaced before encoding, the bytes differ from the text
+        return None
+    return _slice_regions(head_data, tail_data, offsets, len(tokens), head, chunk_length)
+
+
+def _chunk_offsets(tokenizer, tokens, chunk_length, head):
+    """Byte offsets of the chunk boundaries, of the end of the first head tokens and of the end of tokens"""
+    # Byte offsets are only needed at chunk boundaries and at the end of the head
+    boundaries = sorted(set(range(0, len(tokens), chunk_length)) | {head} - {len(tokens)})
+    offsets = {0: 0, len(tokens): 0}
+    if boundaries:
+        ids = tokens if isinstance(tokens, np.ndarray) else np.asarray(tokens)
+        sizes = np.add.reduceat(token_byte_lengths(tokenizer)[ids], boundaries, dtype=np.int64)
+        ends = np.cumsum(sizes).tolist()
+        offsets.update(zip(boundaries[1:] + [len(tokens)], ends))
+    return offsets
+
+
+def _slice_regions(head_data, tail_data, offsets, num_tokens, head, chunk_length):
+    """
+    Text chunks of chunk_length tokens, the first head tokens covering head_data and the rest tail_data
+
+    Args:
+        head_data: str (ASCII) or bytes of exactly the first head tokens
+        tail_data: str (ASCII) or bytes of exactly the tokens after the head
+        offsets: _chunk_offsets of the tokens
+        num_tokens: Number of tokens
+        head: Number of tokens in the head
+        chunk_length: Tokens per chunk
+
+    Returns:
+        List of text chunks
+    """
+    head_bytes = offsets[head]
+    chunks = []
+    for start in range(0, num_tokens, chunk_length):
+        end = min(start + chunk_length, num_tokens)
+        if end <= head:
+            piece = head_data[offsets[start]:offsets[end]]
+        elif start >= head:
+            piece = tail_data[offsets[start] - head_bytes:offsets[end] - head_bytes]
+        else:
+            first, second = head_data[offsets[start]:], tail_data[:offsets[end] - head_bytes]
+            if type(first) is not type(second):
+                first, second = (part.encode("utf8") if isinstance(part, str) else part for part in (first, second))
+            piece = first + second
+        chunks.append(piece if isinstance(piece, str) else piece.decode("utf8", errors="replace"))
+    return chunks
+
+
+def _char_start(data, pos, start):
+    """pos moved back to the start of a UTF-8 character, or forward if that would reach start"""
+    back = pos
+    while back > start and back < len(data) and data[back] & 0xC0 == 0x80:
+        back -= 1
+    if back > start:
+        return back
+    while pos < len(data) and data[pos] & 0xC0 == 0x80:
+        pos += 1
+    return pos
+
+
+def _pack_region(data, offsets, chunk_length):
+    """
+    Cut a region of the text into chunks of at most chunk_length tokens at unit boundaries
+
+    Each chunk ends at the last boundary of the strongest kind that still fits
+    the budget, provided it fills at least half of it; otherwise at the last
+    boundary of any kind, and a unit without boundaries is cut after
+    chunk_length tokens (at a character start). Boundaries are looked up by bisection, so the cost is
+    linear in the length of the region.
+
+    Args:
+        data: UTF-8 bytes of the region
+        offsets: Byte offset of every token start in data, followed by len(data)
+        chunk_length: Maximum number of tokens per chunk
+
+    Returns:
+        List of text chunks
+    """
+    num_tokens = len(offsets) - 1
+    boundaries = [np.array([match.end() for match in pattern.finditer(data)], dtype=np.int64) for pattern in UNIT_BOUNDARIES]
+    chunks = []
+    start = 0
+    while start < len(data):
+        # Tokens overlapping [start, end) count against the budget
+        first = int(np.searchsorted(offsets, start, side="right")) - 1
+        limit = int(offsets[min(first + chunk_length, num_tokens)])
+        end = len(data) if limit >= len(data) else None
+        farthest = start
+        for positions in boundaries if end is None else ():
+            idx = int(np.searchsorted(positions, limit, side="right")) - 1
+            if idx < 0 or positions[idx] <= start:
+                continue
+            farthest = max(farthest, int(positions[idx]))
+            if np.searchsorted(offsets, positions[idx]) - first >= chunk_length // 2:
+                end = int(positions[idx])
+                break
+        if end is None:
+            end = farthest if farthest > start else _char_start(data, limit, start)
+        chunks.append(data[start:end].decode("utf8", errors="replace"))
+        start = end
+    return chunks
+
+
+def pack_chunks(tokenizer, text, tokens, chunk_length, max_length, manner="middle"):
+    """
+    Cut text into chunks of at most chunk_length tokens that keep whole units together
+
+    Units are documents or paragraphs (separated by blank lines), lines and
+    sentences, see UNIT_BOUNDARIES; units longer than chunk_length are cut after
+    chunk_length tokens. Chunk sizes are measured with the byte offsets of the
+    truncated tokens, so nothing is encoded again. The head and tail kept by
+    "middle" truncation are packed separately.
+
+    Args:
+        tokenizer: tiktoken encoding the tokens come from
+        text: The encoded text
+        tokens: encode_truncated(tokenizer, text, max_length, manner)
+        chunk_length: Maximum number of tokens per chunk
+        max_length: Maximum input length the tokens were truncated to
+        manner: Truncation method - "middle" or "front"
+
+    Returns:
+        List of text chunks, or None if the text cannot be packed (use token chunks instead)
+    """
+    if not isinstance(tokenizer, tiktoken.Encoding) or max_length <= 0 or chunk_length <= 0:
+        return None
+
+    head = max_length // 2 if manner == "middle" and len(tokens) >= max_length else len(tokens)
+    ids = tokens if isinstance(tokens, np.ndarray) else np.asarray(tokens)
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum(token_byte_lengths(tokenizer)[ids], out=offsets[1:])
+    head_bytes = int(offsets[head])
+    try:
+        head_data = _byte_region(text, head_bytes)
+        tail_data = _byte_region(text, int(offsets[-1]) - head_bytes, from_end=True)
+    except UnicodeEncodeError:
+        return None
+
+    chunks = []
+    for data, region_offsets in ((head_data, offsets[: head + 1]), (tail_data, offsets[head:] - head_bytes)):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        chunks.extend(_pack_region(data, region_offsets, chunk_length))
+    return chunks
+
+
 def create_chunks(
     tokenizer,
     context: str,
     chunk_length: int,
     input_length: int,
     manner="middle",
+    token_cache=None,
+    chunk_mode="token",
 ) -> list:
     """
     Split the context into chunks
@@ -107,15 +572,27 @@ def create_chunks(
         chunk_length: Length of each chunk
         input_length: Maximum input length to consider
         manner: Truncation method - "middle" or "front"
+        token_cache: Optional TokenCache to take the encoded context from
+        chunk_mode: One of CHUNK_MODES, "token" cuts every chunk_length tokens, "boundary"
+            packs whole documents, paragraphs or sentences into chunks of at most chunk_length tokens
         
     Returns:
         List of text chunks
     """
     if tokenizer:
-        tokens = tokenizer.encode(context)
-        tokens = truncate_input(tokens, input_length, manner=manner)
-        chunked_tokens = chunk_input(tokens, chunk_length)
-        chunks = [tokenizer.decode(chunked_token) for chunked_token in chunked_tokens]
+        if token_cache is not None:
+            tokens = truncate_input(token_cache.encode(tokenizer, context), input_length, manner=manner)
+        else:
+            tokens = encode_truncated(tokenizer, context, input_length, manner=manner)
+        chunks = None
+        if chunk_mode == "boundary":
+            chunks = pack_chunks(tokenizer, context, tokens, chunk_length, input_length, manner=manner)
+        elif isinstance(tokens, np.ndarray):
+            # Slicing pays off for array tokens, converting a list costs about as much as decoding it
+            chunks = slice_chunks(tokenizer, context, tokens, chunk_length, input_length, manner=manner)
+        if chunks is None:
+            chunked_tokens = chunk_input(tokens, chunk_length)
+            chunks = [tokenizer.decode(chunked_token) for chunked_token in chunked_tokens]
     else:
         print("No tokenizer provided. Using raw text.")
         chunks = chunk_input(context, chunk_length)
@@ -123,7 +600,141 @@ def create_chunks(
     return chunks
 
 
-def get_info_score(info, question, task, prompt_module):
+def _stream_head(tokenizer, text, chunk_length, count):
+    """
+    Encode the start of text piece by piece, yielding the chunks within its first count tokens
+
+    Chunks are sliced from the UTF-8 bytes of the encoded text by the byte
+    lengths of their tokens, as in slice_chunks, and decoded only after a lone
+    surrogate made the bytes differ from the tokens.
+
+    Returns:
+        (number of tokens yielded, tokens encoded but not yielded, end of the encoded text,
+        UTF-8 bytes of the tokens not yielded or None if they are not known)
+    """
+    lengths = token_byte_lengths(tokenizer)
+    pending = _concatenate([])
+    data = b""
+    emitted = 0
+    end = 0
+    while emitted + len(pending) < count and end < len(text):
+        new_end = _split_after(text, end + chunk_length * CHARS_PER_TOKEN)
+        piece = text[end:new_end]
+        pending = np.concatenate([pending, encode_array(tokenizer, piece)])
+        data = _extend_bytes(data, piece)
+        end = new_end
+        while len(pending) >= chunk_length and emitted + chunk_length <= count:
+            chunk, pending = pending[:chunk_length], pending[chunk_length:]
+            if data is None:
+                yield tokenizer.decode(chunk.tolist())
+            else:
+                size = int(lengths[chunk].sum())
+                yield data[:size].decode("utf8", errors="replace")
+                data = data[size:]
+            emitted += chunk_length
+    return emitted, pending, end, data
+
+
+def _extend_bytes(data, text):
+    """data followed by the UTF-8 bytes of text, or None if data is None or text has lone surrogates"""
+    if data is None:
+        return None
+    try:
+        return data + text.encode("utf8")
+    except UnicodeEncodeError:
+        # Lone surrogates are replaced before encoding, the bytes differ from the text
+        return None
+
+
+def iter_chunks(
+    tokenizer,
+    context: str,
+    chunk_length: int,
+    input_length: int,
+    manner="middle",
+    token_cache=None,
+    chunk_mode="token",
+):
+    """
+    Split the context into chunks, yielding each chunk as soon as its tokens are encoded
+
+    Yields the same chunks as create_chunks. With a tiktoken encoding and
+    chunk_mode "token", the context is encoded about chunk_length tokens at a
+    time, so the first chunk is ready long before the whole context is encoded;
+    the tail kept by "middle" truncation is encoded once the head is done.
+    Otherwise, and with a token cache, the chunks of create_chunks are yielded.
+
+    Args:
+        tokenizer: Tokenizer to use for encoding/decoding
+        context: Text to split into chunks
+        chunk_length: Length of each chunk
+        input_length: Maximum input length to consider
+        manner: Truncation method - "middle" or "front"
+        token_cache: Optional TokenCache to take the encoded context from
+        chunk_mode: One of CHUNK_MODES
+
+    Yields:
+        Text chunks
+    """
+    if (
+        not isinstance(tokenizer, tiktoken.Encoding) or token_cache is not None or chunk_mode != "token"
+        or input_length <= 0 or chunk_length <= 0
+    ):
+        yield from create_chunks(
+            tokenizer, context, chunk_length, input_length, manner=manner, token_cache=token_cache, chunk_mode=chunk_mode
+        )
+        return
+
+    # The truncated tokens start with the first head_length tokens of the context in any case
+    head_length = input_length // 2 if manner == "middle" else input_length
+    emitted, pending, end, data = yield from _stream_head(tokenizer, context, chunk_length, head_length)
+
+    def truncate_rest(tokens):
+        """Truncated tokens after the emitted ones, given all tokens after them"""
+        if emitted + len(tokens) <= input_length:
+            return tokens
+        if manner == "middle":
+            return np.concatenate([tokens[: head_length - emitted], tokens[len(tokens) - (input_length - head_length) :]])
+        return tokens[: input_length - emitted]
+
+    rest = None
+    if end < len(context) and manner == "middle":
+        tail_length = input_length - head_length
+        tail, start = _encode_tail(tokenizer, context, tail_length)
+        if end <= start and len(tail) >= tail_length:
+            rest = np.concatenate([pending[: head_length - emitted], tail[len(tail) - tail_length :]])
+            tail_source = context
+        else:
+            # Head and tail overlap, the context is about input_length tokens anyway
+            pending = np.concatenate([pending, _tokens_after(tokenizer, context, end, tail, start)])
+            data = _extend_bytes(data, context[end:])
+    if rest is None:
+        cut = manner == "middle" and emitted + len(pending) > input_length
+        rest = truncate_rest(pending)
+        tail_source = data
+    else:
+        cut = True
+
+    # The rest is sliced like the head: its first tokens are covered by data, the tail ends the text
+    head = head_length - emitted if cut else len(rest)
+    offsets = _chunk_offsets(tokenizer, rest, chunk_length, head)
+    tail_bytes = offsets[len(rest)] - offsets[head]
+    tail_data = None
+    if data is not None:
+        try:
+            tail_data = _byte_region(tail_source, tail_bytes, from_end=True) if isinstance(tail_source, str) else (
+                tail_source[len(tail_source) - tail_bytes :]
+            )
+        except UnicodeEncodeError:
+            pass
+    if tail_data is None:
+        for start in range(0, len(rest), chunk_length):
+            yield tokenizer.decode(rest[start : start + chunk_length].tolist())
+        return
+    yield from _slice_regions(data[: offsets[head]], tail_data, offsets, len(rest), head, chunk_length)
+
+
+def get_info_score(info, question, task, prompt_module, max_attempts=3, bounded=True):
     """
     Score the extracted information based on task type
     
@@ -132,9 +743,11 @@ def get_info_score(info, question, task, prompt_module):
         question: The question being answered
         task: Task type ("en", "zh", or "rag")
         prompt_module: Module containing prompt functions
+        max_attempts: Number of times to ask before giving up on a missing score
+        bounded: Whether the first attempt uses the score stage token budget and stop sequence
         
     Returns:
-        Score from 0-100 or 0 for RAG tasks
+        Score from 0-100, or 0 for RAG tasks and when no score could be parsed
     """
     # Score the extracted information based on task type
     if task == "rag":
@@ -145,14 +758,232 @@ def get_info_score(info, question, task, prompt_module):
         return 0
     
     msgs = prompt_module.create_chunked_msgs(prompt)
-    while True:
-        response = chat(msgs)
-        score_match = re.search(r"Score:\s*(\d+)", response)
-        if score_match:
-            score = float(score_match.group(1).strip())
+    for attempt in range(max_attempts):
+        # The score budget is tight, re-ask without it in case the model explained first
+        limits = UNBOUNDED if attempt > 0 or not bounded else None
+        response = chat(msgs, stage="score", limits=limits)
+        score = parse_info_score(response)
+        if score is not None:
             return score
         else:
             print("Invalid response. Please provide a score between 0 and 100.")
+    print(f"No score after {max_attempts} attempts, using 0")
+    return 0
+
+
+def parse_info_score(response):
+    """Parse the "Score: N" value from a scoring response, or None if missing"""
+    score_match = re.search(r"Score:\s*(\d+)", response)
+    if score_match:
+        return float(score_match.group(1).strip())
+    return None
+
+
+def map_output_limits(task, prompt_module, map_output="text"):
+    """
+    Generation limit overrides of the map calls for an output format
+
+    Args:
+        task: Task type ("en", "zh", or "rag")
+        prompt_module: Module containing prompt functions
+        map_output: One of prompt_module.MAP_OUTPUTS
+
+    Returns:
+        Dict with the request's response_format, or None
+    """
+    if map_output == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    if map_output == "json_schema":
+        schema = {"name": "map_extraction", "strict": True, "schema": prompt_module.map_output_schema(task)}
+        return {"response_format": {"type": "json_schema", "json_schema": schema}}
+    return None
+
+
+def parse_map_output(response):
+    """
+    Parse the answer of a fused map call
+
+    Tolerates text or code fences around the JSON object, JSON cut off by the
+    token budget and missing fields; an answer without any JSON field is taken
+    as the extracted information itself, as in text mode.
+
+    Args:
+        response: Answer to a prompt from prompt_module.add_map_output_instruction
+
+    Returns:
+        (information, has_information, score), information is "NO INFORMATION" when
+        has_information is False, score is 0 then and None when missing or invalid
+    """
+    data = None
+    start, end = response.find("{"), response.rfind("}")
+    if 0 <= start < end:
+        try:
+            data = json.loads(response[start : end + 1])
+        except ValueError:
+            pass
+    if not isinstance(data, dict):
+        data = {}
+        for field, pattern in MAP_OUTPUT_FIELDS.items():
+            match = pattern.search(response)
+            if match:
+                data[field] = match.group(1)
+        if "information" in data:
+            try:
+                data["information"] = json.loads(f'"{data["information"]}"')
+            except ValueError:
+                pass
+        elif not data:
+            # Not JSON at all (braces can be part of a plain-text answer)
+            data["information"] = response
+
+    information = str(data.get("information") or "").strip()
+    has_information = data.get("has_information")
+    if isinstance(has_information, str):
+        has_information = has_information.lower() == "true"
+    if not isinstance(has_information, bool):
+        has_information = bool(information) and "no information" not in information.lower()
+    if not has_information:
+        return "NO INFORMATION", False, 0
+    try:
+        score = float(data.get("score"))
+    except (TypeError, ValueError):
+        score = None
+    if score is not None and not 0 <= score <= 100:
+        score = None
+    return information, True, score
+
+
+def parse_batch_scores(response, count):
+    """
+    Parse the numbered scores of a batched scoring response
+
+    Args:
+        response: Response to a get_batch_score_prompt prompt
+        count: Number of items in the prompt
+
+    Returns:
+        Dict mapping item positions (from 0) to scores, items without a valid line are left out
+    """
+    scores = {}
+    for match in BATCH_SCORE_LINE.finditer(response):
+        number, score = int(match.group(1)), float(match.group(2))
+        if 1 <= number <= count and 0 <= score <= 100:
+            scores.setdefault(number - 1, score)
+    return scores
+
+
+def build_score_batches(infos, question, task, prompt_module, batch_tokens, tokenizer=None):
+    """
+    Batched scoring requests for extracted information strings
+
+    The infos are packed in order into groups of at most batch_tokens tokens (a
+    longer info gets a group of its own), each scored by one call.
+
+    Args:
+        infos: List of extracted information to score
+        question: The question being answered
+        task: Task type ("en" or "zh")
+        prompt_module: Module containing prompt functions
+        batch_tokens: Token budget of the infos of one call
+        tokenizer: Tokenizer to count tokens with, characters / CHARS_PER_TOKEN without
+
+    Returns:
+        List of (indices of the infos, chat messages, generation limit overrides) per call
+    """
+    groups = []
+    size = 0
+    for idx, info in enumerate(infos):
+        if tokenizer is not None:
+            tokens = len(tokenizer.encode(info, disallowed_special=()))
+        else:
+            tokens = len(info) // CHARS_PER_TOKEN + 1
+        if not groups or size + tokens > batch_tokens:
+            groups.append([])
+            size = 0
+        groups[-1].append(idx)
+        size += tokens
+
+    # The score budget is per item, and the end-of-line stop would cut the list after one line
+    max_tokens = llm.generation_limits.get("score", {}).get("max_tokens")
+    requests = []
+    for group in groups:
+        prompt = prompt_module.get_batch_score_prompt([infos[idx] for idx in group], question, task)
+        limits = {"max_tokens": max_tokens * len(group) if max_tokens else None, "stop": None}
+        requests.append((group, prompt_module.create_chunked_msgs(prompt), limits))
+    return requests
+
+
+def get_info_scores(
+    infos, question, task, prompt_module, concurrency=None, batch_tokens=0, tokenizer=None, scores=None
+):
+    """
+    Score several extracted information strings in parallel
+    
+    Args:
+        infos: List of extracted information to score
+        question: The question being answered
+        task: Task type ("en", "zh", or "rag")
+        prompt_module: Module containing prompt functions
+        concurrency: Maximum number of scoring calls in flight at once
+        batch_tokens: Score the infos in calls of up to this many tokens of infos each,
+            0 for one call per info; scores missing from a batched response are asked one by one
+        tokenizer: Tokenizer to count the tokens of infos with when batching
+        scores: Scores already known, e.g. from fused map calls, only the None entries are scored
+        
+    Returns:
+        List of scores in the same order as infos
+    """
+    if task == "rag":
+        return [0 for _ in infos]
+
+    if scores is not None:
+        scores = list(scores)
+        missing = [idx for idx, score in enumerate(scores) if score is None]
+        if missing:
+            found = get_info_scores(
+                [infos[idx] for idx in missing], question, task, prompt_module,
+                concurrency=concurrency, batch_tokens=batch_tokens, tokenizer=tokenizer,
+            )
+            for idx, score in zip(missing, found):
+                scores[idx] = score
+        return scores
+
+    if batch_tokens:
+        requests = build_score_batches(infos, question, task, prompt_module, batch_tokens, tokenizer=tokenizer)
+        responses = chat_many(
+            [msgs for group, msgs, limits in requests],
+            concurrency=concurrency,
+            stage="score",
+            limits=[limits for group, msgs, limits in requests],
+        )
+        scores = [None for _ in infos]
+        for (group, msgs, limits), response in zip(requests, responses):
+            for position, score in parse_batch_scores(response, len(group)).items():
+                scores[group[position]] = score
+        missing = [idx for idx, score in enumerate(scores) if score is None]
+        if missing:
+            print(f"{len(missing)} of {len(infos)} scores missing from batched responses, scoring them one by one")
+            fallback = get_info_scores([infos[idx] for idx in missing], question, task, prompt_module, concurrency)
+            for idx, score in zip(missing, fallback):
+                scores[idx] = score
+        return scores
+
+    prompts = [prompt_module.get_info_score_prompt(info, question, task) for info in infos]
+    pending = [idx for idx, prompt in enumerate(prompts) if prompt]
+    responses = chat_many(
+        [prompt_module.create_chunked_msgs(prompts[idx]) for idx in pending],
+        concurrency=concurrency,
+        stage="score",
+    )
+
+    scores = [0 for _ in infos]
+    for idx, response in zip(pending, responses):
+        score = parse_info_score(response)
+        if score is None:
+            # Fall back to re-asking for unparsable responses
+            score = get_info_score(infos[idx], question, task, prompt_module, max_attempts=2, bounded=False)
+        scores[idx] = score
+    return scores
 
 
 def postprocess_prediction(prediction, question, prompt_module):
@@ -173,7 +1004,7 @@ def postprocess_prediction(prediction, question, prompt_module):
     messages = prompt_module.create_chunked_msgs(prompt)
     try:
         reduce_start_time = time.time()
-        response = chat(messages)
+        response = chat(messages, stage="postprocess")
         reduce_end_time = time.time()
         return response, (reduce_end_time - reduce_start_time)
     except Exception as e: